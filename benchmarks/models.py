@@ -0,0 +1,48 @@
+"""Memory held by parsed messages and the cost of measuring their records.
+
+Run from the repository root: python -m benchmarks.models
+"""
+
+from typing import Any, List
+from benchmarks.parse import QUERY, RESPONSE
+from dinodns.core.message import DNSMessage
+import timeit
+import tracemalloc
+
+
+def retained(data: bytes, count: int) -> float:
+    """Bytes still allocated per message while `count` parsed copies are alive."""
+    DNSMessage.from_bytes(data, 0)  # warm up caches and fail fast
+    tracemalloc.start()
+    messages = [DNSMessage.from_bytes(data, 0) for _ in range(count)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del messages
+    return current / count
+
+
+def bench(label: str, data: bytes, number: int) -> None:
+    message = DNSMessage.from_bytes(data, 0)
+    entries: List[Any] = [
+        message.header,
+        *message.questions,
+        *message.answers,
+        *message.authorities,
+        *message.additional,
+    ]
+    best = min(
+        timeit.repeat(
+            lambda: [entry.byte_length() for entry in entries],
+            number=number,
+            repeat=5,
+        )
+    )
+    print(
+        f"{label:<10} {retained(data, 1000):8.0f} bytes/message"
+        f"  {best / number / len(entries) * 1e6:6.2f} us/byte_length"
+    )
+
+
+if __name__ == "__main__":
+    bench("query", QUERY, 20000)
+    bench("response", RESPONSE, 5000)
@@ -0,0 +1,58 @@
+"""Micro-benchmark of DNSMessage.from_bytes on a typical query and response,
+and of the header-and-question fast path queries take.
+
+Run from the repository root: python -m benchmarks.parse
+"""
+
+from typing import Any, Callable, List
+from dinodns.core.message import DNSMessage
+from dinodns.core.query import parse_query
+import struct
+import timeit
+
+
+def name(domain: str) -> bytes:
+    return b"".join(
+        bytes([len(label)]) + label.encode() for label in domain.split(".")
+    ) + b"\x00"
+
+
+def rr(owner: bytes, rr_type: int, ttl: int, rdata: bytes) -> bytes:
+    return owner + struct.pack("!HHIH", rr_type, 1, ttl, len(rdata)) + rdata
+
+
+QUESTION = name("www.example.com") + struct.pack("!HH", 1, 1)
+QUERY = struct.pack("!HHHHHH", 0x1234, 0x0100, 1, 0, 0, 0) + QUESTION
+
+ANSWERS: List[bytes] = [
+    rr(name("www.example.com"), 1, 300, bytes([192, 0, 2, i])) for i in range(4)
+]
+AUTHORITIES = [
+    rr(name("example.com"), 2, 3600, name(f"ns{i}.example.com")) for i in range(2)
+]
+ADDITIONAL = [
+    rr(name(f"ns{i}.example.com"), 1, 3600, bytes([198, 51, 100, i])) for i in range(2)
+]
+RESPONSE = (
+    struct.pack("!HHHHHH", 0x1234, 0x8180, 1, 4, 2, 2)
+    + QUESTION
+    + b"".join(ANSWERS + AUTHORITIES + ADDITIONAL)
+)
+
+
+def full(data: bytes) -> Any:
+    return DNSMessage.from_bytes(data, 0)
+
+
+def bench(
+    label: str, data: bytes, number: int, parse: Callable[[bytes], Any] = full
+) -> None:
+    assert parse(data) is not None  # fail fast on parse errors
+    best = min(timeit.repeat(lambda: parse(data), number=number, repeat=5))
+    print(f"{label:<10} {len(data):>4} bytes  {best / number * 1e6:8.2f} us/message")
+
+
+if __name__ == "__main__":
+    bench("query", QUERY, 50000)
+    bench("fast query", QUERY, 50000, parse_query)
+    bench("response", RESPONSE, 10000)
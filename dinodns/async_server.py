@@ -0,0 +1,108 @@
+from typing import TYPE_CHECKING, Any, Optional, Set, TypeVar
+from dinodns.core.query import QueryView
+from dinodns.server import DinoDNS
+from dinodns.steps import Spawn, Steps
+import asyncio
+import logging
+
+if TYPE_CHECKING:
+    from dinodns.tcp_server import TCPServer
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Upstream resolutions outliving the query that started them
+refreshes: Set["asyncio.Task[Any]"] = set()
+
+
+async def forward_query(server: DinoDNS, query: QueryView) -> Optional[bytes]:
+    return await run_async(server.forward_steps(query))
+
+
+async def run_async(steps: Steps[T]) -> T:
+    """Drive `steps` on the event loop, background steps as tasks of their own."""
+    outcome: Any = None
+    error: Optional[Exception] = None
+    while True:
+        try:
+            step = steps.send(outcome) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        outcome, error = None, None
+        if isinstance(step, Spawn):
+            task = asyncio.ensure_future(run_async(step.steps))
+            refreshes.add(task)
+            task.add_done_callback(refreshes.discard)
+            continue
+        try:
+            # Shielded: giving up must not cancel a future other queries wait on
+            outcome = await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(step.future)), step.timeout
+            )
+        except Exception as e:
+            error = e
+
+
+class DNSServerProtocol(asyncio.DatagramProtocol):
+    """Answers cached and catalog queries inline; only forwards become tasks."""
+
+    def __init__(self, server: DinoDNS) -> None:
+        self.server = server
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.pending: Set["asyncio.Task[None]"] = set()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport  # type: ignore[assignment]
+
+    def datagram_received(self, data: bytes, addr: Any) -> None:
+        server = self.server
+        try:
+            response = server.packet_cache.get(data, server.compiled)
+            if response is None:
+                query = server.decode_query(data)
+                if isinstance(query, bytes):
+                    response = query
+                else:
+                    response = server.try_answer_locally(query)
+                    if response is None:
+                        task = asyncio.ensure_future(self.forward(query, addr))
+                        self.pending.add(task)
+                        task.add_done_callback(self.pending.discard)
+                        return
+            self.send(response, addr)
+        except Exception as e:
+            logger.error(f'msg="Error handling client query: {e}" addr={addr}"')
+
+    async def forward(self, query: QueryView, addr: Any) -> None:
+        try:
+            response = await forward_query(self.server, query)
+            self.send(response or self.server.servfail(query), addr)
+        except Exception as e:
+            logger.error(f'msg="Error handling client query: {e}" addr={addr}"')
+
+    def send(self, response: bytes, addr: Any) -> None:
+        if self.transport is not None:
+            self.transport.sendto(response, addr)
+
+
+async def serve(server: DinoDNS, tcp: Optional["TCPServer"] = None) -> None:
+    server.bind()
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: DNSServerProtocol(server), sock=server.socket
+    )
+    listener = await tcp.listen() if tcp is not None else None
+    try:
+        await asyncio.Future()  # serve until cancelled
+    finally:
+        transport.close()
+        if listener is not None:
+            listener.close()
+
+
+def start(server: DinoDNS, tcp: Optional["TCPServer"] = None) -> None:
+    try:
+        asyncio.run(serve(server, tcp))
+    except KeyboardInterrupt:
+        logger.info('msg="Shutting down"')
@@ -1,69 +1,475 @@
+import heapq
+import itertools
+import struct
 import time
 import logging
 from collections import OrderedDict
-from typing import Optional, Tuple
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 from threading import Lock
+from dinodns.core.header import TC_BIT, RCode
+from dinodns.core.rr.types import Type
+from dinodns.utils import skip_domain_name
 
 logger = logging.getLogger(__name__)
 
 
+# Caps from RFC 2308 section 5 (negative) and common resolver practice (positive)
+MAX_TTL = 86400
+MAX_NEGATIVE_TTL = 10800
+# TTL of expired answers served while upstreams are unreachable (RFC 8767 section 4)
+STALE_TTL = 30
+# Hits an entry needs before it is worth refreshing ahead of expiry
+PREFETCH_MIN_HITS = 3
+DEFAULT_SHARDS = 16
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+# Rough bytes of bookkeeping per entry (key tuple, CacheEntry, dict and heap slots)
+ENTRY_OVERHEAD = 300
+# Least recently used entries weighed against each other when evicting by size
+EVICTION_SAMPLE = 4
+
+# (qname, qtype, qclass, rd, cd)
+CacheKey = Tuple[str, int, int, int, int]
+
+
+def cacheable(data: bytes) -> Optional[Tuple[bytes, int, Tuple[int, ...]]]:
+    """Return a response as it should be cached, how long, and the offsets of its TTL fields.
+
+    Positive answers live for the smallest TTL they carry. NXDOMAIN and NODATA
+    answers live for min(SOA TTL, SOA MINIMUM) of the authority SOA (RFC 2308)
+    and are not cached without one; their records are replayed with TTLs
+    capped at that negative TTL.
+    """
+    try:
+        flags, qdcount, ancount, nscount, arcount = struct.unpack_from(
+            "!HHHHH", data, 2
+        )
+        rcode = flags & 0xF
+        if flags & TC_BIT or rcode not in (RCode.NOERROR.value, RCode.NXDOMAIN.value):
+            return None  # truncated or failed answers are not cached
+
+        offset = 12
+        for _ in range(qdcount):
+            offset = skip_domain_name(data, offset) + 4
+
+        ttls: List[int] = []
+        offsets: List[int] = []
+        negative_ttl: Optional[int] = None
+        for index in range(ancount + nscount + arcount):
+            offset = skip_domain_name(data, offset)
+            rr_type, ttl, rdlength = struct.unpack_from("!H2xIH", data, offset)
+            rdata = offset + 10
+            if rr_type != Type.OPT.value:
+                offsets.append(offset + 4)
+                ttls.append(ttl)
+                in_authority = ancount <= index < ancount + nscount
+                if rr_type == Type.SOA.value and in_authority:
+                    minimum_offset = skip_domain_name(
+                        data, skip_domain_name(data, rdata)
+                    )
+                    (minimum,) = struct.unpack_from("!I", data, minimum_offset + 16)
+                    negative_ttl = min(ttl, minimum)
+            offset = rdata + rdlength
+        if offset > len(data):
+            return None
+    except (IndexError, struct.error):
+        return None
+
+    if ancount == 0 or rcode == RCode.NXDOMAIN.value:
+        if negative_ttl is None:
+            return None
+        ttl = min(negative_ttl, MAX_NEGATIVE_TTL)
+        if ttl > 0 and max(ttls) > ttl:
+            data = capped_response(data, tuple(offsets), ttl)
+    else:
+        ttl = min(min(ttls), MAX_TTL)
+
+    if ttl <= 0:
+        return None
+    return data, ttl, tuple(offsets)
+
+
+def capped_response(response: bytes, ttl_offsets: Tuple[int, ...], ttl: int) -> bytes:
+    capped = bytearray(response)
+    for offset in ttl_offsets:
+        (current,) = struct.unpack_from("!I", capped, offset)
+        struct.pack_into("!I", capped, offset, min(current, ttl))
+    return bytes(capped)
+
+
+def age_response(response: bytes, ttl_offsets: Tuple[int, ...], elapsed: int) -> bytes:
+    if not ttl_offsets or elapsed <= 0:
+        return response
+    aged = bytearray(response)
+    for offset in ttl_offsets:
+        (ttl,) = struct.unpack_from("!I", aged, offset)
+        struct.pack_into("!I", aged, offset, max(ttl - elapsed, 0))
+    return bytes(aged)
+
+
+def stale_response(response: bytes, ttl_offsets: Tuple[int, ...]) -> bytes:
+    stale = bytearray(response)
+    for offset in ttl_offsets:
+        struct.pack_into("!I", stale, offset, STALE_TTL)
+    return bytes(stale)
+
+
+@dataclass(slots=True)
+class CacheEntry:
+    response: bytes
+    expiry: float
+    stored_at: float
+    ttl_offsets: Tuple[int, ...] = ()
+    source: Optional[str] = None  # upstream that produced the response
+    hits: int = 0
+    prefetched: bool = False
+
+    @property
+    def size(self) -> int:
+        return len(self.response) + 4 * len(self.ttl_offsets) + ENTRY_OVERHEAD
+
+
 class DNSCache:
     def __init__(
-        self, max_size: Optional[int] = None, enable_logging: bool = False
+        self,
+        max_size: Optional[int] = None,
+        enable_logging: bool = False,
+        stale_window: int = 0,
+        prefetch_fraction: float = 0.0,
+        max_bytes: Optional[int] = None,
     ) -> None:
-        self._store: "OrderedDict[Tuple[str, str, str], Tuple[bytes, float]]" = (
-            OrderedDict()
-        )
+        self._store: "OrderedDict[CacheKey, CacheEntry]" = OrderedDict()
         self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
         self.enable_logging = enable_logging
+        # Seconds an expired entry is kept around for get_stale
+        self.stale_window = stale_window
+        # Share of its TTL an entry has left when claim_prefetch hands it out
+        self.prefetch_fraction = prefetch_fraction
+        self.hits = 0
+        self.misses = 0
+        self.hits_by_source: Dict[str, int] = {}
+        # (removal time, key) per stored entry; outdated items are skipped on pop
+        self._expiries: List[Tuple[float, CacheKey]] = []
         self._lock = Lock()
 
-    def get(self, key: Tuple[str, str, str]) -> Optional[bytes]:
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def _remove(self, key: CacheKey) -> None:
+        self.bytes -= self._store.pop(key).size
+
+    def _evict(self, incoming: int) -> None:
+        """Make room for an entry of `incoming` bytes.
+
+        Among the few least recently used entries the largest goes first, so
+        one cold 4 KB response is dropped before dozens of small answers.
+        """
+        while self._store and (
+            (self.max_size is not None and len(self._store) >= self.max_size)
+            or (self.max_bytes is not None and self.bytes + incoming > self.max_bytes)
+        ):
+            candidates = itertools.islice(self._store.items(), EVICTION_SAMPLE)
+            evicted_key, _ = max(candidates, key=lambda item: item[1].size)
+            self._remove(evicted_key)
+            self.evictions += 1
+            if self.enable_logging:
+                logger.debug(f'msg="Cache evicted" key={evicted_key}')
+
+    def _expire(self, now: float) -> None:
+        expiries = self._expiries
+        while expiries and expiries[0][0] <= now:
+            _, key = heapq.heappop(expiries)
+            entry = self._store.get(key)
+            if entry is not None and entry.expiry + self.stale_window <= now:
+                self._remove(key)
+                if self.enable_logging:
+                    logger.debug(f'msg="Cache cleaned" key={key}')
+        # Items of overwritten or evicted entries linger until their time
+        # comes; rebuild once they outnumber the live ones
+        if len(expiries) > 2 * len(self._store) + 64:
+            self._expiries = [
+                (entry.expiry + self.stale_window, key)
+                for key, entry in self._store.items()
+            ]
+            heapq.heapify(self._expiries)
+
+    def get(self, key: CacheKey) -> Optional[bytes]:
+        now = time.time()
         with self._lock:
             entry = self._store.get(key)
             if entry is None:
+                self.misses += 1
                 return None
-            response, expiry = entry
-            if time.time() > expiry:
-                del self._store[key]
+            if now > entry.expiry:
+                if now > entry.expiry + self.stale_window:
+                    self._remove(key)
+                self.misses += 1
                 if self.enable_logging:
                     logger.debug(f'msg="Cache expired" key={key}')
                 return None
-            if self.max_size is not None:
+            if self.max_size is not None or self.max_bytes is not None:
                 self._store.move_to_end(key)  # LRU update
+            self.hits += 1
+            entry.hits += 1
+            if entry.source is not None:
+                self.hits_by_source[entry.source] = (
+                    self.hits_by_source.get(entry.source, 0) + 1
+                )
             if self.enable_logging:
                 logger.debug(f'msg="Cache hit" key={key}')
-            return response
+        # Replay with TTLs counting down the time spent in cache
+        return age_response(
+            entry.response, entry.ttl_offsets, int(now - entry.stored_at)
+        )
 
-    def set(self, key: Tuple[str, str, str], response: bytes, ttl: int) -> None:
-        expiry = time.time() + ttl
+    def claim_prefetch(self, key: CacheKey) -> bool:
+        """True once per entry, when it is hot and close enough to expiry to refresh."""
+        now = time.time()
         with self._lock:
-            if key in self._store:
-                del self._store[key]
-            elif self.max_size is not None and len(self._store) >= self.max_size:
-                evicted_key, _ = self._store.popitem(last=False)
-                if self.enable_logging:
-                    logger.debug(f'msg="Cache evicted" key={evicted_key}')
-            self._store[key] = (response, expiry)
+            entry = self._store.get(key)
+            if (
+                entry is None
+                or entry.prefetched
+                or entry.hits < PREFETCH_MIN_HITS
+                or now > entry.expiry
+                or entry.expiry - now > (entry.expiry - entry.stored_at) * self.prefetch_fraction
+            ):
+                return False
+            entry.prefetched = True
+            return True
+
+    def get_stale(self, key: CacheKey) -> Optional[bytes]:
+        """Return an expired entry still inside the stale window, with TTLs set to STALE_TTL."""
+        now = time.time()
+        with self._lock:
+            entry = self._store.get(key)
+        if entry is None or now > entry.expiry + self.stale_window:
+            return None
+        if now <= entry.expiry:
+            return age_response(
+                entry.response, entry.ttl_offsets, int(now - entry.stored_at)
+            )
+        return stale_response(entry.response, entry.ttl_offsets)
+
+    def set(
+        self,
+        key: CacheKey,
+        response: bytes,
+        ttl: int,
+        ttl_offsets: Tuple[int, ...] = (),
+        source: Optional[str] = None,
+    ) -> None:
+        now = time.time()
+        entry = CacheEntry(
+            response=response,
+            expiry=now + ttl,
+            stored_at=now,
+            ttl_offsets=ttl_offsets,
+            source=source,
+        )
+        with self._lock:
+            self._expire(now)
+            self._insert(key, entry)
             if self.enable_logging:
                 logger.debug(f'msg="Cache set" key={key} ttl={ttl}s')
 
-    def __contains__(self, key: Tuple[str, str, str]) -> bool:
+    def _insert(self, key: CacheKey, entry: CacheEntry) -> None:
+        if key in self._store:
+            self._remove(key)
+        if self.max_bytes is not None and entry.size > self.max_bytes:
+            return
+        self._evict(entry.size)
+        self._store[key] = entry
+        self.bytes += entry.size
+        heapq.heappush(self._expiries, (entry.expiry + self.stale_window, key))
+
+    def entries(self) -> List[Tuple[CacheKey, CacheEntry]]:
+        """Entries from least to most recently used."""
+        with self._lock:
+            return list(self._store.items())
+
+    def restore(self, entries: List[Tuple[CacheKey, CacheEntry]]) -> None:
+        """Insert entries as they were saved, skipping those past the stale window."""
+        # Bulk path for snapshot loading: insert everything in one pass, then
+        # evict from the least recently used end until the limits hold again
+        stale_window = self.stale_window
+        now = time.time()
+        with self._lock:
+            store = self._store
+            expiries = self._expiries
+            for key, entry in entries:
+                removal = entry.expiry + stale_window
+                if removal <= now:
+                    continue
+                if key in store:
+                    continue  # answered since startup, so fresher than the snapshot
+                store[key] = entry
+                self.bytes += entry.size
+                expiries.append((removal, key))
+            heapq.heapify(expiries)
+            self._evict(0)
+
+    def __contains__(self, key: CacheKey) -> bool:
         with self._lock:
             entry = self._store.get(key)
             if entry is None:
                 return False
-            _, expiry = entry
-            if time.time() > expiry:
-                del self._store[key]
+            now = time.time()
+            if now > entry.expiry:
+                if now > entry.expiry + self.stale_window:
+                    self._remove(key)
                 return False
             return True
 
     def cleanup(self) -> None:
-        now = time.time()
         with self._lock:
-            expired_keys = [k for k, (_, expiry) in self._store.items() if expiry < now]
-            for k in expired_keys:
-                del self._store[k]
-                if self.enable_logging:
-                    logger.debug(f'msg="Cache cleaned" key={k}')
+            self._expire(time.time())
+
+
+class ShardedDNSCache:
+    """DNSCache split into shards by key hash, each with its own lock and LRU.
+
+    Drop-in for DNSCache: threads working on different names rarely contend,
+    which matters most on free-threaded builds. `max_size` and `max_bytes`
+    are shared evenly, so eviction order is per shard.
+    """
+
+    def __init__(
+        self,
+        shards: int = DEFAULT_SHARDS,
+        max_size: Optional[int] = None,
+        enable_logging: bool = False,
+        stale_window: int = 0,
+        prefetch_fraction: float = 0.0,
+        max_bytes: Optional[int] = None,
+    ) -> None:
+        self._shards = [
+            DNSCache(
+                max_size=None if max_size is None else max(max_size // shards, 1),
+                enable_logging=enable_logging,
+                stale_window=stale_window,
+                prefetch_fraction=prefetch_fraction,
+                max_bytes=None if max_bytes is None else max_bytes // shards,
+            )
+            for _ in range(shards)
+        ]
+
+    def _shard(self, key: CacheKey) -> DNSCache:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+    @property
+    def bytes(self) -> int:
+        return sum(shard.bytes for shard in self._shards)
+
+    @property
+    def evictions(self) -> int:
+        return sum(shard.evictions for shard in self._shards)
+
+    @property
+    def hits(self) -> int:
+        return sum(shard.hits for shard in self._shards)
+
+    @property
+    def misses(self) -> int:
+        return sum(shard.misses for shard in self._shards)
+
+    @property
+    def hits_by_source(self) -> Dict[str, int]:
+        totals: Dict[str, int] = {}
+        for shard in self._shards:
+            for source, hits in list(shard.hits_by_source.items()):
+                totals[source] = totals.get(source, 0) + hits
+        return totals
+
+    def get(self, key: CacheKey) -> Optional[bytes]:
+        return self._shard(key).get(key)
+
+    def entries(self) -> List[Tuple[CacheKey, CacheEntry]]:
+        return [item for shard in self._shards for item in shard.entries()]
+
+    def restore(self, entries: List[Tuple[CacheKey, CacheEntry]]) -> None:
+        shards = len(self._shards)
+        by_shard: List[List[Tuple[CacheKey, CacheEntry]]] = [[] for _ in range(shards)]
+        for item in entries:
+            by_shard[hash(item[0]) % shards].append(item)
+        for shard, shard_entries in zip(self._shards, by_shard):
+            shard.restore(shard_entries)
+
+    def claim_prefetch(self, key: CacheKey) -> bool:
+        return self._shard(key).claim_prefetch(key)
+
+    def get_stale(self, key: CacheKey) -> Optional[bytes]:
+        return self._shard(key).get_stale(key)
+
+    def set(
+        self,
+        key: CacheKey,
+        response: bytes,
+        ttl: int,
+        ttl_offsets: Tuple[int, ...] = (),
+        source: Optional[str] = None,
+    ) -> None:
+        self._shard(key).set(key, response, ttl, ttl_offsets, source)
+
+    def __contains__(self, key: CacheKey) -> bool:
+        return key in self._shard(key)
+
+    def cleanup(self) -> None:
+        for shard in self._shards:
+            shard.cleanup()
+
+
+class PacketCache:
+    """Whole-response cache keyed on the request bytes after the transaction ID.
+
+    Entries belong to the catalog they were computed from and are dropped as
+    soon as a lookup is made against a different one.
+    """
+
+    def __init__(self, max_size: int = 10000) -> None:
+        self._store: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self._owner: object = None
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+
+    def get(self, data: bytes, owner: object) -> Optional[bytes]:
+        key = data[2:]
+        with self._lock:
+            if owner is not self._owner:
+                if self._store:
+                    logger.info(
+                        f'msg="Packet cache invalidated" entries={len(self._store)}'
+                    )
+                self._store.clear()
+                self._owner = owner
+            response = self._store.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self._store.move_to_end(key)
+            self.hits += 1
+        return data[:2] + response[2:]  # patch transaction ID
+
+    def set(self, data: bytes, response: bytes, owner: object) -> None:
+        key = data[2:]
+        with self._lock:
+            if owner is not self._owner:
+                return
+            if key in self._store:
+                self._store.move_to_end(key)
+            elif len(self._store) >= self.max_size:
+                self._store.popitem(last=False)
+                self.evictions += 1
+            self._store[key] = response
+
+    def __len__(self) -> int:
+        return len(self._store)
@@ -1,7 +1,8 @@
 from dataclasses import dataclass
 from dinodns.core.question import DNSQuestion
-from dinodns.utils import convert_keys
-from typing import List, Optional, Tuple, Union, Literal
+from dinodns.utils import convert_keys, normalize_domain_name, qualify_domain_name
+from dinodns.zone_tree import LookupResult, LookupStatus, ZoneTree
+from typing import Dict, List, Optional, Tuple, Union, Literal
 from click import Path
 import click
 import dacite
@@ -56,17 +57,68 @@ class SOARecord:
 
 Record = Union[ARecord, CNAMERecord, NSRecord, SOARecord]
 
+# (normalized fqdn, type, class)
+RecordKey = Tuple[str, str, str]
 
-@dataclass
+
+# Zones and RRsets hash by identity so derived forms can be keyed on them
+@dataclass(eq=False)
 class Zone:
     origin: str
     records: List[Record]
 
+    def record_fqdn(self, record: Record) -> str:
+        return qualify_domain_name(record.domain_name, self.origin)
+
+
+@dataclass(eq=False)
+class RRset:
+    records: List[Record]
+    zone: Zone
+
+    @property
+    def origin(self) -> str:
+        return self.zone.origin
+
 
 @dataclass
 class Catalog:
     zones: List[Zone]
 
+    def __post_init__(self) -> None:
+        self.build_index()
+
+    def build_index(self) -> None:
+        index: Dict[RecordKey, RRset] = {}
+        tree = ZoneTree()
+        for zone in self.zones:
+            tree.add_zone(zone)
+            for record in zone.records:
+                key = (
+                    normalize_domain_name(zone.record_fqdn(record)),
+                    record.type,
+                    record.class_,
+                )
+                rrset = index.get(key)
+                if rrset is None:
+                    index[key] = rrset = RRset(records=[record], zone=zone)
+                    tree.add_rrset(*key, rrset)
+                elif rrset.zone is zone:
+                    rrset.records.append(record)
+                else:
+                    logger.warning(
+                        f'msg="Duplicate RRset across zones ignored" name={key[0]} type={key[1]} zone={zone.origin}'
+                    )
+
+        # Every RRset, including glue below zone cuts
+        self._index: Dict[RecordKey, RRset] = index
+        # Only RRsets this server answers authoritatively for
+        self._answers: Dict[RecordKey, RRset] = {
+            (name, type, class_): rrset
+            for name, type, class_, rrset in tree.authoritative_rrsets()
+        }
+        self._tree = tree
+
     def __str__(self) -> str:
         entries: List[str] = []
         for i, zone in enumerate(self.zones):
@@ -104,26 +156,29 @@ class Catalog:
         )
         return catalog
 
-    def try_lookup_record(self, question: DNSQuestion) -> Optional[Tuple[Record, str]]:
-        qname = question.qname.rstrip(".").lower()
-
-        for zone in self.zones:
-            origin = zone.origin.rstrip(".").lower()
+    def lookup(self, question: DNSQuestion) -> LookupResult:
+        qname = normalize_domain_name(question.qname)
+        rrset = self._answers.get((qname, question.qtype.name, question.qclass.name))
+        if rrset is not None:
+            return LookupResult(
+                status=LookupStatus.ANSWER, zone=rrset.zone, rrset=rrset
+            )
+        return self._tree.lookup(qname, question.qtype.name, question.qclass.name)
 
-            if not qname.endswith(origin):
-                continue
+    def rrsets(self) -> List[RRset]:
+        return list(self._index.values())
 
-            for record in zone.records:
-                record_relative = record.domain_name.rstrip(".").lower()
-                record_fqdn = (
-                    origin if record_relative == "@" else f"{record_relative}.{origin}"
-                )
-
-                if (
-                    record_fqdn == qname
-                    and question.qtype.name == record.type
-                    and question.qclass.name == record.class_
-                ):
-                    return record, zone.origin
+    def try_lookup_rrset(self, question: DNSQuestion) -> Optional[RRset]:
+        return self._index.get(
+            (
+                normalize_domain_name(question.qname),
+                question.qtype.name,
+                question.qclass.name,
+            )
+        )
 
-        return None
+    def try_lookup_record(self, question: DNSQuestion) -> Optional[Tuple[Record, str]]:
+        rrset = self.try_lookup_rrset(question)
+        if rrset is None:
+            return None
+        return rrset.records[0], rrset.origin
@@ -0,0 +1,197 @@
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+from dinodns.catalog import Catalog, RRset, SOARecord, Zone
+from dinodns.core.header import DNSHeader
+from dinodns.core.question import QUESTION_STRUCT, DNSQuestion, QClass, QType
+from dinodns.core.rr.resource_record import DNSResourceRecord
+from dinodns.core.wire import (
+    MAX_POINTER,
+    POINTER_FLAG,
+    POINTER_STRUCT,
+    WireWriter,
+    encode,
+    encode_labels,
+)
+from dinodns.utils import encoded_length
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# The question always starts right after the header
+QUESTION_POINTER = POINTER_STRUCT.pack(POINTER_FLAG | DNSHeader.HEADER_SIZE)
+
+
+@dataclass(frozen=True)
+class WireSection:
+    count: int
+    data: bytes
+
+
+@dataclass(frozen=True)
+class CompiledSections:
+    """Answer, authority and additional sections encoded as one block.
+
+    Names are compressed against each other and against a question for
+    `anchor`; a question for a name below it only shifts every pointer by
+    the length difference, so the block is relocated rather than re-encoded.
+    `plain` is the same block uncompressed, for questions it does not fit.
+    """
+
+    ancount: int
+    nscount: int
+    arcount: int
+    data: bytes
+    plain: bytes
+    # Lowercased wire form of the name the question is compiled for
+    anchor: bytes = b""
+    # Offsets in `data` of the compression pointers
+    pointers: Tuple[int, ...] = ()
+
+    def for_question(self, raw_question: bytes) -> bytes:
+        qname = raw_question[:-4]
+        shift = len(qname) - len(self.anchor)
+        if shift < 0 or qname[shift:].lower() != self.anchor:
+            return self.plain
+        if not shift or not self.pointers:
+            return self.data
+
+        data = bytearray(self.data)
+        for offset in self.pointers:
+            (pointer,) = POINTER_STRUCT.unpack_from(data, offset)
+            if (pointer & MAX_POINTER) + shift > MAX_POINTER:
+                return self.plain
+            POINTER_STRUCT.pack_into(data, offset, pointer + shift)
+        return bytes(data)
+
+
+EMPTY_SECTIONS = CompiledSections(ancount=0, nscount=0, arcount=0, data=b"", plain=b"")
+
+
+def compile_sections(
+    anchor: str,
+    answers: List[DNSResourceRecord] = [],
+    authorities: List[DNSResourceRecord] = [],
+    additional: List[DNSResourceRecord] = [],
+) -> CompiledSections:
+    rrs = answers + authorities + additional
+    writer = WireWriter()
+    writer.compress()
+    # Lay the sections out behind a header and a question for `anchor`
+    writer.reserve(DNSHeader.HEADER_SIZE)
+    writer.write_name(anchor)
+    writer.reserve(QUESTION_STRUCT.size)
+    start = writer.offset
+    for rr in rrs:
+        rr.write(writer)
+    return CompiledSections(
+        ancount=len(answers),
+        nscount=len(authorities),
+        arcount=len(additional),
+        data=bytes(writer.buffer[start : writer.offset]),
+        plain=encode(*rrs),
+        anchor=encode_labels(anchor, ".").lower(),
+        pointers=tuple(offset - start for offset in writer.pointers),
+    )
+
+
+@dataclass(frozen=True)
+class CompiledRRset:
+    # Each RR of the set in wire format, without its owner name
+    bodies: Tuple[bytes, ...]
+    # The set as the answer to a question for its owner, or as a referral
+    answer: CompiledSections
+    referral: CompiledSections
+    glue: WireSection
+
+    def synthesized(self) -> CompiledSections:
+        """Answer for a name matched by this wildcard set, owned by the question."""
+        data = b"".join(QUESTION_POINTER + body for body in self.bodies)
+        return CompiledSections(
+            ancount=len(self.bodies),
+            nscount=0,
+            arcount=self.glue.count,
+            data=data + self.glue.data,
+            plain=data + self.glue.data,
+        )
+
+
+def try_glue_resource_records(
+    catalog: Catalog, rr: DNSResourceRecord
+) -> List[DNSResourceRecord]:
+    if not rr.requires_glue_record():
+        return []
+
+    domain_name = rr.rdata.domain_name_target
+    if not domain_name:
+        return []
+
+    glue_question = DNSQuestion(
+        qname=domain_name,
+        qtype=QType.A,
+        qclass=QClass.IN,
+    )
+
+    rrset = catalog.try_lookup_rrset(glue_question)
+    if not rrset:
+        logger.warning(f'msg="No record found for {glue_question.qname}"')
+        return []
+
+    return [
+        DNSResourceRecord.from_record(record, rrset.origin) for record in rrset.records
+    ]
+
+
+def soa_resource_records(rrset: RRset) -> List[DNSResourceRecord]:
+    rrs: List[DNSResourceRecord] = []
+    for record in rrset.records:
+        rr = DNSResourceRecord.from_record(record, rrset.origin)
+        # RFC 2308 section 3: negative TTL is min(SOA TTL, SOA MINIMUM)
+        if isinstance(record, SOARecord):
+            rr.ttl = min(rr.ttl, record.minimum)
+        rrs.append(rr)
+    return rrs
+
+
+class CompiledCatalog:
+    """Catalog whose RRsets are serialized once, at load time."""
+
+    def __init__(self, catalog: Catalog) -> None:
+        self.catalog = catalog
+        self._rrsets: Dict[RRset, CompiledRRset] = {}
+        self._negative: Dict[Zone, CompiledSections] = {}
+
+        for rrset in catalog.rrsets():
+            self._rrsets[rrset] = self._compile_rrset(rrset)
+
+        for zone in catalog.zones:
+            soa = catalog.try_lookup_rrset(
+                DNSQuestion(qname=zone.origin, qtype=QType.SOA, qclass=QClass.IN)
+            )
+            if soa is not None:
+                self._negative[zone] = compile_sections(
+                    zone.origin, authorities=soa_resource_records(soa)
+                )
+
+    def _compile_rrset(self, rrset: RRset) -> CompiledRRset:
+        rrs: List[DNSResourceRecord] = []
+        glue: List[DNSResourceRecord] = []
+        for record in rrset.records:
+            rr = DNSResourceRecord.from_record(record, rrset.origin)
+            rrs.append(rr)
+            glue.extend(try_glue_resource_records(self.catalog, rr))
+
+        owner = rrs[0].name
+        owner_length = encoded_length(owner)
+        return CompiledRRset(
+            bodies=tuple(rr.to_bytes()[owner_length:] for rr in rrs),
+            answer=compile_sections(owner, answers=rrs, additional=glue),
+            referral=compile_sections(owner, authorities=rrs, additional=glue),
+            glue=WireSection(count=len(glue), data=encode(*glue)),
+        )
+
+    def rrset(self, rrset: RRset) -> CompiledRRset:
+        return self._rrsets[rrset]
+
+    def negative(self, zone: Zone) -> CompiledSections:
+        return self._negative.get(zone, EMPTY_SECTIONS)
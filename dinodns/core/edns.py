@@ -0,0 +1,98 @@
+from typing import Optional, Tuple
+from dinodns.core.header import HEADER_STRUCT, TC_BIT, DNSHeader
+from dinodns.core.rr.resource_record import RR_STRUCT
+from dinodns.core.rr.types import Type
+from dinodns.utils import Buffer, skip_domain_name
+import struct
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+EDNS_VERSION = 0
+# Largest UDP reply without EDNS (RFC 1035 section 4.2.1)
+MIN_PAYLOAD_SIZE = 512
+# UDP payload we advertise and answer up to: the DNS Flag Day 2020 value,
+# small enough to avoid IP fragmentation on common paths
+PAYLOAD_SIZE = 1232
+
+# root owner, type, class (UDP payload size), TTL (extended RCODE, version,
+# flags), RDLENGTH
+OPT_STRUCT = struct.Struct("!BHHIH")
+
+
+def opt_record(extended_rcode: int = 0) -> bytes:
+    """Our OPT pseudo-RR, advertising PAYLOAD_SIZE, without options."""
+    return OPT_STRUCT.pack(
+        0, Type.OPT.value, PAYLOAD_SIZE, extended_rcode << 24 | EDNS_VERSION << 16, 0
+    )
+
+
+OPT_RECORD = opt_record()
+
+
+def negotiate(advertised: int) -> int:
+    """UDP reply size limit for a client advertising `advertised` bytes."""
+    return min(max(advertised, MIN_PAYLOAD_SIZE), PAYLOAD_SIZE)
+
+
+def find_opt(data: Buffer) -> Optional[Tuple[int, int]]:
+    """Start and end offsets of the first OPT RR in the additional section."""
+    _, _, qdcount, ancount, nscount, arcount = HEADER_STRUCT.unpack_from(data, 0)
+    if not arcount:
+        return None
+    offset = DNSHeader.HEADER_SIZE
+    for _ in range(qdcount):
+        offset = skip_domain_name(data, offset) + 4
+    for index in range(ancount + nscount + arcount):
+        start = offset
+        offset = skip_domain_name(data, offset)
+        rr_type, _, _, rdlength = RR_STRUCT.unpack_from(data, offset)
+        offset += RR_STRUCT.size + rdlength
+        if rr_type == Type.OPT.value and index >= ancount + nscount:
+            return start, offset
+    return None
+
+
+def truncated(response: bytes, question_end: int, edns: bool) -> bytes:
+    """Header and question of `response` with TC set, and our OPT for EDNS clients."""
+    id, flags, _, _, _, _ = HEADER_STRUCT.unpack_from(response, 0)
+    return b"".join(
+        (
+            HEADER_STRUCT.pack(id, flags | TC_BIT, 1, 0, 0, int(edns)),
+            response[DNSHeader.HEADER_SIZE : question_end],
+            OPT_RECORD if edns else b"",
+        )
+    )
+
+
+def fit_response(response: bytes, question_end: int, edns: bool, payload: int) -> bytes:
+    """Adapt a forwarded response to one client.
+
+    Whatever OPT record the upstream sent is replaced by ours for EDNS
+    clients and dropped for the others; a reply larger than `payload`
+    is cut back to its question with TC set.
+    """
+    try:
+        opt = find_opt(response)
+    except (IndexError, struct.error):
+        return response  # pass malformed upstream replies through as they were
+    if opt is not None:
+        start, end = opt
+        (arcount,) = struct.unpack_from("!H", response, 10)
+        response = b"".join(
+            (
+                response[:10],
+                struct.pack("!H", arcount - 1),
+                response[DNSHeader.HEADER_SIZE : start],
+                response[end:],
+            )
+        )
+    if edns:
+        (arcount,) = struct.unpack_from("!H", response, 10)
+        response = b"".join(
+            (response[:10], struct.pack("!H", arcount + 1), response[12:], OPT_RECORD)
+        )
+    if len(response) > payload:
+        return truncated(response, question_end, edns)
+    return response
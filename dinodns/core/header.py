@@ -2,12 +2,30 @@ from dataclasses import dataclass
 from enum import Enum
 from typing import ClassVar
 from tabulate import tabulate
-from dinodns.utils import format_bits
+from dinodns.core.wire import WireWriter, encode
+from dinodns.utils import Buffer, format_bits
+import struct
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+HEADER_STRUCT = struct.Struct("!HHHHHH")
+
+# Bits of the 16-bit flags word
+QR_BIT = 0x8000
+OPCODE_MASK = 0x7800
+AA_BIT = 0x0400
+TC_BIT = 0x0200
+RD_BIT = 0x0100
+RA_BIT = 0x0080
+# The one bit of RFC 1035's 3-bit Z field still reserved; the other two are
+# AD and CD (RFC 4035)
+Z_MASK = 0x0040
+AD_BIT = 0x0020  # Authentic Data
+CD_BIT = 0x0010  # Checking Disabled
+RCODE_MASK = 0x000F
+
 
 class OpCode(Enum):
     QUERY = 0
@@ -26,9 +44,10 @@ class RCode(Enum):
     XRRSET = 7
     NOTAUTH = 8
     NOTZONE = 9
+    BADVERS = 16  # extended, its upper bits travel in the OPT record
 
 
-@dataclass
+@dataclass(slots=True)
 class Flags:
     qr: int
     opcode: OpCode
@@ -84,7 +103,7 @@ class Flags:
         return self.to_int().to_bytes(2, "big")
 
 
-@dataclass
+@dataclass(slots=True)
 class DNSHeader:
     id: int
     flags: Flags
@@ -134,10 +153,12 @@ class DNSHeader:
         )
 
     @classmethod
-    def from_bytes(cls, data: bytes, offset: int) -> "DNSHeader":
-        flags = int.from_bytes(data[offset + 2 : 4], "big")
+    def from_bytes(cls, data: Buffer, offset: int) -> "DNSHeader":
+        id, flags, qdcount, ancount, nscount, arcount = HEADER_STRUCT.unpack_from(
+            data, offset
+        )
         return cls(
-            id=int.from_bytes(data[offset:2], "big"),
+            id=id,
             flags=Flags(
                 qr=(flags >> 15) & 0x1,
                 opcode=OpCode((flags >> 11) & 0xF),
@@ -148,21 +169,25 @@ class DNSHeader:
                 z=(flags >> 4) & 0x7,
                 rcode=RCode(flags & 0xF),
             ),
-            qdcount=int.from_bytes(data[offset + 4 : 6], "big"),
-            ancount=int.from_bytes(data[offset + 6 : 8], "big"),
-            nscount=int.from_bytes(data[offset + 8 : 10], "big"),
-            arcount=int.from_bytes(data[offset + 10 : 12], "big"),
+            qdcount=qdcount,
+            ancount=ancount,
+            nscount=nscount,
+            arcount=arcount,
         )
 
-    def to_bytes(self) -> bytes:
-        return (
-            self.id.to_bytes(2, "big")
-            + self.flags.to_bytes()
-            + self.qdcount.to_bytes(2, "big")
-            + self.ancount.to_bytes(2, "big")
-            + self.nscount.to_bytes(2, "big")
-            + self.arcount.to_bytes(2, "big")
+    def write(self, writer: WireWriter) -> None:
+        writer.write_struct(
+            HEADER_STRUCT,
+            self.id,
+            self.flags.to_int(),
+            self.qdcount,
+            self.ancount,
+            self.nscount,
+            self.arcount,
         )
 
+    def to_bytes(self) -> bytes:
+        return encode(self)
+
     def byte_length(self) -> int:
-        return len(self.to_bytes())
+        return self.HEADER_SIZE
@@ -1,14 +1,18 @@
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 from dinodns.core.rr.resource_record import DNSResourceRecord
+from dinodns.core.rr.types import Type
 from dinodns.core.header import DNSHeader
 from dinodns.core.question import DNSQuestion
+from dinodns.core.wire import WireWriter, encode
 import logging
 
 logger = logging.getLogger(__name__)
 
+MAX_MESSAGE_SIZE = 65535
 
-@dataclass
+
+@dataclass(slots=True)
 class DNSMessage:
     header: DNSHeader
     questions: List[DNSQuestion]
@@ -28,34 +32,33 @@ class DNSMessage:
 
     @classmethod
     def from_bytes(cls, data: bytes, offset: int) -> "DNSMessage":
-        if len(data) > 512:
-            raise ValueError("DNS message exceeds maximum length of 512 bytes")
+        if len(data) > MAX_MESSAGE_SIZE:
+            raise ValueError(
+                f"DNS message exceeds maximum length of {MAX_MESSAGE_SIZE} bytes"
+            )
 
-        header = DNSHeader.from_bytes(data, offset)
-        offset += header.byte_length()
+        view = memoryview(data)
+        header = DNSHeader.from_bytes(view, offset)
+        offset += DNSHeader.HEADER_SIZE
 
         questions: List[DNSQuestion] = []
         for _ in range(header.qdcount):
-            question = DNSQuestion.from_bytes(data, offset)
-            offset += question.byte_length()
+            question, offset = DNSQuestion.parse(view, offset)
             questions.append(question)
 
         answers: List[DNSResourceRecord] = []
         for _ in range(header.ancount):
-            rr = DNSResourceRecord.from_bytes(data, offset)
-            offset += rr.byte_length()
+            rr, offset = DNSResourceRecord.parse(view, offset)
             answers.append(rr)
 
         authorities: List[DNSResourceRecord] = []
         for _ in range(header.nscount):
-            rr = DNSResourceRecord.from_bytes(data, offset)
-            offset += rr.byte_length()
+            rr, offset = DNSResourceRecord.parse(view, offset)
             authorities.append(rr)
 
         additional: List[DNSResourceRecord] = []
         for _ in range(header.arcount):
-            rr = DNSResourceRecord.from_bytes(data, offset)
-            offset += rr.byte_length()
+            rr, offset = DNSResourceRecord.parse(view, offset)
             additional.append(rr)
 
         return cls(
@@ -66,22 +69,30 @@ class DNSMessage:
             additional=additional,
         )
 
-    def to_bytes(self) -> bytes:
-        data = self.header.to_bytes()
+    def write(self, writer: WireWriter) -> None:
+        self.header.write(writer)
 
         for question in self.questions:
-            data += question.to_bytes()
+            question.write(writer)
 
         for i in range(self.header.ancount):
-            data += self.answers[i].to_bytes()
+            self.answers[i].write(writer)
 
         for i in range(self.header.nscount):
-            data += self.authorities[i].to_bytes()
+            self.authorities[i].write(writer)
 
         for i in range(self.header.arcount):
-            data += self.additional[i].to_bytes()
+            self.additional[i].write(writer)
 
-        return data
+    def to_bytes(self) -> bytes:
+        return encode(self, compress=True)
+
+    def opt(self) -> Optional[DNSResourceRecord]:
+        """The EDNS(0) OPT pseudo-RR of the additional section, if any."""
+        for rr in self.additional:
+            if rr.type == Type.OPT:
+                return rr
+        return None
 
     def is_query(self) -> bool:
         return self.header.flags.qr == 0
@@ -94,6 +105,10 @@ class DNSMessage:
         self.answers.extend(answers)
         self.header.ancount += len(answers)
 
+    def set_authorities(self, authorities: list["DNSResourceRecord"]) -> None:
+        self.authorities.extend(authorities)
+        self.header.nscount += len(authorities)
+
     def set_additional(self, additional: list["DNSResourceRecord"]) -> None:
         self.additional.extend(additional)
         self.header.arcount += len(additional)
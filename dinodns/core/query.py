@@ -0,0 +1,173 @@
+from typing import Optional
+from dinodns.core.edns import (
+    EDNS_VERSION,
+    MIN_PAYLOAD_SIZE,
+    OPT_RECORD,
+    OPT_STRUCT,
+    fit_response,
+    negotiate,
+)
+from dinodns.core.header import (
+    AD_BIT,
+    CD_BIT,
+    HEADER_STRUCT,
+    OPCODE_MASK,
+    QR_BIT,
+    RCODE_MASK,
+    RD_BIT,
+    TC_BIT,
+    Z_MASK,
+    DNSHeader,
+    RCode,
+)
+from dinodns.core.message import DNSMessage
+from dinodns.core.question import QUESTION_STRUCT, DNSQuestion, QClass, QType
+from dinodns.core.rr.types import Type
+from dinodns.utils import decode_domain_name
+import struct
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+MAX_TCP_MESSAGE_SIZE = 65535
+# Anything set here sends the query down the full parser and feature checks
+SLOW_PATH_FLAGS = QR_BIT | OPCODE_MASK | TC_BIT | Z_MASK
+
+
+class QueryView:
+    """The header and single question of a query, read straight off the wire.
+
+    `data` is the request as received; `question_end` is the offset just
+    past its question section. `payload` is the largest reply the client
+    takes: over UDP, negotiated from its OPT record when `edns` is set.
+    """
+
+    __slots__ = (
+        "id",
+        "flags",
+        "question",
+        "question_end",
+        "data",
+        "edns",
+        "payload",
+        "tcp",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        flags: int,
+        question: DNSQuestion,
+        question_end: int,
+        data: bytes,
+        edns: bool = False,
+        payload: int = MIN_PAYLOAD_SIZE,
+    ) -> None:
+        self.id = id
+        self.flags = flags
+        self.question = question
+        self.question_end = question_end
+        self.data = data
+        self.edns = edns
+        self.payload = payload
+        self.tcp = False
+
+    @property
+    def rd(self) -> int:
+        return (self.flags & RD_BIT) >> 8
+
+    @property
+    def cd(self) -> int:
+        return (self.flags & CD_BIT) >> 4
+
+    @property
+    def raw_question(self) -> bytes:
+        return self.data[DNSHeader.HEADER_SIZE : self.question_end]
+
+    def over_tcp(self) -> None:
+        """Mark the query as received over TCP, where replies are never truncated."""
+        self.tcp = True
+        self.payload = MAX_TCP_MESSAGE_SIZE
+
+    def upstream_query(self) -> bytes:
+        """The query to forward: this question with our own OPT record.
+
+        Upstreams then answer up to our payload size whatever the client
+        advertised, and `fit` cuts the reply down per client.
+        """
+        return b"".join(
+            (
+                HEADER_STRUCT.pack(self.id, self.flags, 1, 0, 0, 1),
+                self.raw_question,
+                OPT_RECORD,
+            )
+        )
+
+    def fit(self, response: bytes) -> bytes:
+        return fit_response(response, self.question_end, self.edns, self.payload)
+
+    def with_rcode(self, rcode: RCode) -> bytes:
+        """The request echoed back with `rcode` set, as the full parser would.
+
+        AD is cleared: nothing in an error reply has been authenticated.
+        """
+        flags = (self.flags & ~(RCODE_MASK | AD_BIT)) | rcode.value
+        return self.data[:2] + flags.to_bytes(2, "big") + self.data[4:]
+
+    @classmethod
+    def from_message(cls, message: DNSMessage, data: bytes) -> "QueryView":
+        question = message.questions[0]
+        opt = message.opt()
+        return cls(
+            message.header.id,
+            message.header.flags.to_int(),
+            question,
+            DNSHeader.HEADER_SIZE + question.wire_length,
+            data,
+            edns=opt is not None,
+            payload=MIN_PAYLOAD_SIZE if opt is None else negotiate(opt.class_.value),
+        )
+
+
+def parse_query(data: bytes) -> Optional[QueryView]:
+    """Decode just the header and question of a plain single-question query.
+
+    Returns None whenever the request needs the full parser: responses,
+    other opcodes, TC or the reserved Z bit, records other than a version 0 OPT,
+    non-IN classes, or anything malformed.
+    """
+    try:
+        id, flags, qdcount, ancount, nscount, arcount = HEADER_STRUCT.unpack_from(
+            data, 0
+        )
+        if flags & SLOW_PATH_FLAGS or qdcount != 1 or ancount or nscount:
+            return None
+        qname, offset = decode_domain_name(data, DNSHeader.HEADER_SIZE)
+        qtype, qclass = QUESTION_STRUCT.unpack_from(data, offset)
+        question_end = offset + QUESTION_STRUCT.size
+        end, payload = question_end, MIN_PAYLOAD_SIZE
+        if arcount == 1:
+            owner, rr_type, advertised, ttl, rdlength = OPT_STRUCT.unpack_from(
+                data, question_end
+            )
+            version = (ttl >> 16) & 0xFF
+            if owner or rr_type != Type.OPT.value or version != EDNS_VERSION:
+                return None
+            end += OPT_STRUCT.size + rdlength
+            payload = negotiate(advertised)
+        elif arcount:
+            return None
+    except (ValueError, struct.error):
+        return None
+    if qclass != QClass.IN.value or end != len(data):
+        return None
+    return QueryView(
+        id,
+        flags,
+        DNSQuestion(qname, QType(qtype), QClass.IN),
+        question_end,
+        data,
+        edns=arcount == 1,
+        payload=payload,
+    )
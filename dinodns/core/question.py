@@ -1,11 +1,16 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
+from typing import Tuple
+from dinodns.core.wire import WireWriter, encode
+from dinodns.utils import Buffer, decode_domain_name, encoded_length
+import struct
 import logging
-from typing import List
 
 
 logger = logging.getLogger(__name__)
 
+QUESTION_STRUCT = struct.Struct("!HH")
+
 
 class QType(Enum):
     UNKNOWN = -1
@@ -59,11 +64,13 @@ class QClass(Enum):
         return obj
 
 
-@dataclass
+@dataclass(slots=True)
 class DNSQuestion:
     qname: str
     qtype: QType
     qclass: QClass
+    # Bytes the question took in the message it was parsed from, names compressed
+    wire_length: int = field(default=0, repr=False, compare=False)
 
     def __str__(self) -> str:
         return f"qname={self.qname} qtype={self.qtype.name} qclass={self.qclass.name}"
@@ -76,30 +83,24 @@ class DNSQuestion:
         )
 
     @classmethod
-    def from_bytes(cls, data: bytes, offset: int) -> "DNSQuestion":
-        labels: List[str] = []
-        while data[offset] != 0:
-            length = data[offset]
-            offset += 1
-            labels.append(data[offset : offset + length].decode())
-            offset += length
-        offset += 1  # skip null byte
-        qname = ".".join(labels) + "."
-        qtype = QType(int.from_bytes(data[offset : offset + 2], "big"))
-        qclass = QClass(int.from_bytes(data[offset + 2 : offset + 4], "big"))
-        return cls(qname=qname, qtype=qtype, qclass=qclass)
+    def from_bytes(cls, data: Buffer, offset: int) -> "DNSQuestion":
+        return cls.parse(data, offset)[0]
+
+    @classmethod
+    def parse(cls, data: Buffer, offset: int) -> Tuple["DNSQuestion", int]:
+        """Decode the question at `offset` and return it with the offset just past it."""
+        start = offset
+        qname, offset = decode_domain_name(data, offset)
+        qtype, qclass = QUESTION_STRUCT.unpack_from(data, offset)
+        offset += QUESTION_STRUCT.size
+        return cls(qname, QType(qtype), QClass(qclass), offset - start), offset
+
+    def write(self, writer: WireWriter) -> None:
+        writer.write_name(self.qname)
+        writer.write_struct(QUESTION_STRUCT, self.qtype.value, self.qclass.value)
 
     def to_bytes(self) -> bytes:
-        qname_bytes = (
-            b"".join(
-                len(label).to_bytes(1, "big") + label.encode()
-                for label in self.qname.rstrip(".").split(".")
-            )
-            + b"\x00"
-        )
-        qtype_bytes = self.qtype.value.to_bytes(2, "big")
-        qclass_bytes = self.qclass.value.to_bytes(2, "big")
-        return qname_bytes + qtype_bytes + qclass_bytes
+        return encode(self)
 
     def byte_length(self) -> int:
-        return len(self.to_bytes())
+        return encoded_length(self.qname) + QUESTION_STRUCT.size
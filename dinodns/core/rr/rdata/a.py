@@ -3,10 +3,16 @@ from ipaddress import IPv4Address
 from dinodns.catalog import ARecord, Record
 from dinodns.core.rr.rdata.base import RData, register_rdata
 from dinodns.core.rr.types import Type
+from dinodns.core.wire import WireWriter
+from dinodns.utils import Buffer
+import struct
+
+
+ADDRESS_STRUCT = struct.Struct("!I")
 
 
 @register_rdata
-@dataclass
+@dataclass(slots=True)
 class RDataA(RData):
     address: IPv4Address
 
@@ -16,8 +22,18 @@ class RDataA(RData):
             raise ValueError(f"Invalid IPv4 address length: {len(data)} bytes")
         return cls(address=IPv4Address(data))
 
-    def to_bytes(self) -> bytes:
-        return self.address.packed
+    @classmethod
+    def from_wire(cls, message: Buffer, offset: int, length: int) -> "RDataA":
+        if length != 4:
+            raise ValueError(f"Invalid IPv4 address length: {length} bytes")
+        (address,) = ADDRESS_STRUCT.unpack_from(message, offset)
+        return cls(address=IPv4Address(address))
+
+    def write(self, writer: WireWriter) -> None:
+        writer.write_struct(ADDRESS_STRUCT, int(self.address))
+
+    def byte_length(self) -> int:
+        return ADDRESS_STRUCT.size
 
     @classmethod
     def rr_type(cls) -> Type:
@@ -2,9 +2,13 @@ from abc import ABC, abstractmethod
 from typing import Dict, List, Optional
 from dinodns.catalog import Record
 from dinodns.core.rr.types import Type
+from dinodns.core.wire import WireWriter, encode
+from dinodns.utils import Buffer
 
 
 class RData(ABC):
+    __slots__ = ()
+
     @property
     def domain_name_target(self) -> Optional[str]:
         return None
@@ -14,10 +18,18 @@ class RData(ABC):
     def from_bytes(cls, data: bytes) -> "RData":
         raise NotImplementedError()
 
+    @classmethod
+    def from_wire(cls, message: Buffer, offset: int, length: int) -> "RData":
+        """Decode RDATA in place inside a whole message; override to avoid the copy."""
+        return cls.from_bytes(bytes(message[offset : offset + length]))
+
     @abstractmethod
-    def to_bytes(self) -> bytes:
+    def write(self, writer: WireWriter) -> None:
         raise NotImplementedError()
 
+    def to_bytes(self) -> bytes:
+        return encode(self)
+
     @classmethod
     @abstractmethod
     def rr_type(cls) -> Type:
@@ -33,6 +45,7 @@ class RData(ABC):
         return False
 
     def byte_length(self) -> int:
+        """Length of `to_bytes()`; override to compute it without encoding."""
         return len(self.to_bytes())
 
 
@@ -52,6 +65,13 @@ class RDataFactory:
             raise NotImplementedError(f"Unsupported Type: {type.name} ({type.value})")
         return rdata_type.from_bytes(data)
 
+    @staticmethod
+    def from_wire(type: Type, message: Buffer, offset: int, length: int) -> RData:
+        rdata_type = _registry.get(type)
+        if rdata_type is None:
+            raise NotImplementedError(f"Unsupported Type: {type.name} ({type.value})")
+        return rdata_type.from_wire(message, offset, length)
+
     @staticmethod
     def from_record(record: Record) -> RData:
         type = Type[record.type]
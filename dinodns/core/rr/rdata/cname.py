@@ -2,11 +2,16 @@ from dataclasses import dataclass
 from dinodns.catalog import CNAMERecord, Record
 from dinodns.core.rr.rdata.base import RData, register_rdata
 from dinodns.core.rr.types import Type
-from dinodns.utils import decode_domain_name, encode_domain_name
+from dinodns.core.wire import WireWriter
+from dinodns.utils import (
+    Buffer,
+    decode_domain_name,
+    encoded_length,
+)
 
 
 @register_rdata
-@dataclass
+@dataclass(slots=True)
 class RDataCNAME(RData):
     cname: str
 
@@ -18,8 +23,15 @@ class RDataCNAME(RData):
     def from_bytes(cls, data: bytes) -> "RDataCNAME":
         return cls(cname=decode_domain_name(data)[0])
 
-    def to_bytes(self) -> bytes:
-        return encode_domain_name(self.cname)
+    @classmethod
+    def from_wire(cls, message: Buffer, offset: int, length: int) -> "RDataCNAME":
+        return cls(cname=decode_domain_name(message, offset)[0])
+
+    def write(self, writer: WireWriter) -> None:
+        writer.write_name(self.cname)
+
+    def byte_length(self) -> int:
+        return encoded_length(self.cname)
 
     @classmethod
     def rr_type(cls) -> Type:
@@ -0,0 +1,36 @@
+from dataclasses import dataclass
+from dinodns.catalog import Record
+from dinodns.core.rr.rdata.base import RData, register_rdata
+from dinodns.core.rr.types import Type
+from dinodns.core.wire import WireWriter
+from dinodns.utils import Buffer
+
+
+@register_rdata
+@dataclass(slots=True)
+class RDataOPT(RData):
+    """EDNS(0) options (RFC 6891), kept as the raw code/length/value sequence."""
+
+    options: bytes
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "RDataOPT":
+        return cls(options=data)
+
+    @classmethod
+    def from_wire(cls, message: Buffer, offset: int, length: int) -> "RDataOPT":
+        return cls(options=bytes(message[offset : offset + length]))
+
+    def write(self, writer: WireWriter) -> None:
+        writer.write(self.options)
+
+    def byte_length(self) -> int:
+        return len(self.options)
+
+    @classmethod
+    def rr_type(cls) -> Type:
+        return Type.OPT
+
+    @classmethod
+    def from_record(cls, record: Record) -> "RDataOPT":
+        raise TypeError("OPT pseudo-records cannot appear in a catalog")
@@ -2,16 +2,22 @@ from dataclasses import dataclass
 from dinodns.catalog import SOARecord, Record
 from dinodns.core.rr.rdata.base import RData, register_rdata
 from dinodns.core.rr.types import Type
+from dinodns.core.wire import WireWriter
 from dinodns.utils import (
+    Buffer,
     decode_domain_name,
     decode_email,
-    encode_domain_name,
-    encode_email,
+    encoded_length,
 )
+import struct
+
+
+# serial, refresh, retry, expire, minimum
+TIMERS_STRUCT = struct.Struct("!IIIII")
 
 
 @register_rdata
-@dataclass
+@dataclass(slots=True)
 class RDataSOA(RData):
     mname: str  # Primary master name server
     rname: str  # Responsible person's email
@@ -23,29 +29,34 @@ class RDataSOA(RData):
 
     @classmethod
     def from_bytes(cls, data: bytes) -> "RDataSOA":
-        offset = 0
-
-        mname, mname_len = decode_domain_name(data)
-        offset += mname_len
-        rname, rname_len = decode_email(data[offset:])
-        offset += rname_len
-        serial = int.from_bytes(data[offset : offset + 4], "big")
-        refresh = int.from_bytes(data[offset + 4 : offset + 8], "big")
-        retry = int.from_bytes(data[offset + 8 : offset + 12], "big")
-        expire = int.from_bytes(data[offset + 12 : offset + 16], "big")
-        minimum = int.from_bytes(data[offset + 16 : offset + 20], "big")
+        return cls.from_wire(data, 0, len(data))
 
+    @classmethod
+    def from_wire(cls, message: Buffer, offset: int, length: int) -> "RDataSOA":
+        mname, offset = decode_domain_name(message, offset)
+        rname, offset = decode_email(message, offset)
+        serial, refresh, retry, expire, minimum = TIMERS_STRUCT.unpack_from(
+            message, offset
+        )
         return cls(mname, rname, serial, refresh, retry, expire, minimum)
 
-    def to_bytes(self) -> bytes:
+    def write(self, writer: WireWriter) -> None:
+        writer.write_name(self.mname)
+        writer.write_email(self.rname)
+        writer.write_struct(
+            TIMERS_STRUCT,
+            self.serial,
+            self.refresh,
+            self.retry,
+            self.expire,
+            self.minimum,
+        )
+
+    def byte_length(self) -> int:
         return (
-            encode_domain_name(self.mname)
-            + encode_email(self.rname)
-            + self.serial.to_bytes(4, "big")
-            + self.refresh.to_bytes(4, "big")
-            + self.retry.to_bytes(4, "big")
-            + self.expire.to_bytes(4, "big")
-            + self.minimum.to_bytes(4, "big")
+            encoded_length(self.mname)
+            + encoded_length(self.rname)
+            + TIMERS_STRUCT.size
         )
 
     @classmethod
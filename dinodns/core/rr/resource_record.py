@@ -1,15 +1,26 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Tuple
 from dinodns.catalog import Record
 from dinodns.core.rr.classes import Class
 from dinodns.core.rr.rdata.base import RData, RDataFactory
 from dinodns.core.rr.types import Type
-from dinodns.utils import decode_domain_name, encode_domain_name
+from dinodns.core.wire import WireWriter, encode
+from dinodns.utils import (
+    Buffer,
+    decode_domain_name,
+    encoded_length,
+    qualify_domain_name,
+)
+import struct
 import logging
 
 logger = logging.getLogger(__name__)
 
+# type, class, TTL, RDLENGTH
+RR_STRUCT = struct.Struct("!HHIH")
 
-@dataclass
+
+@dataclass(slots=True)
 class DNSResourceRecord:
     name: str
     type: Type
@@ -17,6 +28,8 @@ class DNSResourceRecord:
     ttl: int
     rdlength: int
     rdata: RData
+    # Bytes the record took in the message it was parsed from, names compressed
+    wire_length: int = field(default=0, repr=False, compare=False)
 
     def __str__(self) -> str:
         return (
@@ -37,26 +50,34 @@ class DNSResourceRecord:
         )
 
     @classmethod
-    def from_bytes(cls, data: bytes, offset: int) -> "DNSResourceRecord":
-        name, offset = decode_domain_name(data, offset)
+    def from_bytes(cls, data: Buffer, offset: int) -> "DNSResourceRecord":
+        return cls.parse(data, offset)[0]
 
-        type = Type(int.from_bytes(data[offset : offset + 2], "big"))
-        class_ = Class(int.from_bytes(data[offset + 2 : offset + 4], "big"))
-        ttl = int.from_bytes(data[offset + 4 : offset + 8], "big")
+    @classmethod
+    def parse(cls, data: Buffer, offset: int) -> Tuple["DNSResourceRecord", int]:
+        """Decode the record at `offset` and return it with the offset just past it.
 
-        rdlength = int.from_bytes(data[offset + 8 : offset + 10], "big")
-        rdata_bytes = data[offset + 10 : offset + 10 + rdlength]
-        rdata = RDataFactory.from_bytes(type, rdata_bytes)
+        `data` is the whole message so compressed names, in the owner or in
+        the RDATA, can be followed.
+        """
+        start = offset
+        name, offset = decode_domain_name(data, offset)
+        type_value, class_value, ttl, rdlength = RR_STRUCT.unpack_from(data, offset)
+        offset += RR_STRUCT.size
+        if offset + rdlength > len(data):
+            raise ValueError("RDATA extends past the end of the message")
 
-        return cls(
-            name=name, type=type, class_=class_, ttl=ttl, rdlength=rdlength, rdata=rdata
+        type = Type(type_value)
+        rdata = RDataFactory.from_wire(type, data, offset, rdlength)
+        offset += rdlength
+        return (
+            cls(name, type, Class(class_value), ttl, rdlength, rdata, offset - start),
+            offset,
         )
 
     @classmethod
     def from_record(cls, record: Record, origin: str) -> "DNSResourceRecord":
-        fqdn = (
-            origin if record.domain_name == "@" else f"{record.domain_name}.{origin}"
-        ).rstrip(".") + "."
+        fqdn = qualify_domain_name(record.domain_name, origin)
         rdata = RDataFactory.from_record(record)
         return cls(
             name=fqdn,
@@ -67,25 +88,33 @@ class DNSResourceRecord:
             rdata=rdata,
         )
 
-    def to_bytes(self) -> bytes:
-        name_bytes = encode_domain_name(self.name)
-        type_bytes = self.type.value.to_bytes(2, "big")
-        class_bytes = self.class_.value.to_bytes(2, "big")
-        ttl_bytes = self.ttl.to_bytes(4, "big")
-        rdlength_bytes = self.rdlength.to_bytes(2, "big")
-        rdata_bytes = self.rdata.to_bytes()
+    def write(self, writer: WireWriter) -> None:
+        writer.write_name(self.name)
+        if writer.names is None:
+            rdlength = self.rdata.byte_length()
+            writer.write_struct(
+                RR_STRUCT, self.type.value, self.class_.value, self.ttl, rdlength
+            )
+            self.rdata.write(writer)
+            return
 
-        return (
-            name_bytes
-            + type_bytes
-            + class_bytes
-            + ttl_bytes
-            + rdlength_bytes
-            + rdata_bytes
+        # Compressed names in the RDATA make RDLENGTH known only afterwards
+        start = writer.reserve(RR_STRUCT.size)
+        self.rdata.write(writer)
+        RR_STRUCT.pack_into(
+            writer.buffer,
+            start,
+            self.type.value,
+            self.class_.value,
+            self.ttl,
+            writer.offset - start - RR_STRUCT.size,
         )
 
+    def to_bytes(self) -> bytes:
+        return encode(self)
+
     def byte_length(self) -> int:
-        return len(self.to_bytes())
+        return encoded_length(self.name) + RR_STRUCT.size + self.rdata.byte_length()
 
     def requires_glue_record(self) -> bool:
         return self.rdata.requires_glue_record()
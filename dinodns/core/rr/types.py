@@ -22,6 +22,7 @@ class Type(Enum):
     AAAA = 28
     SRV = 33
     NAPTR = 35
+    OPT = 41
     SVCB = 64
     HTTPS = 65
 
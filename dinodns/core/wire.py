@@ -0,0 +1,142 @@
+from functools import lru_cache
+from threading import local
+from typing import Any, Dict, List, Optional, Protocol
+import struct
+
+
+INITIAL_SIZE = 4096
+MAX_LABEL_LENGTH = 63
+NAME_CACHE_SIZE = 4096
+# RFC 1035 section 4.1.4: a pointer is two bytes, 11 followed by a 14-bit offset
+POINTER_FLAG = 0xC000
+MAX_POINTER = 0x3FFF
+
+POINTER_STRUCT = struct.Struct("!H")
+
+
+class Encodable(Protocol):
+    def write(self, writer: "WireWriter") -> None: ...
+
+
+class WireWriter:
+    """Encodes DNS wire format into one growing, reusable bytearray.
+
+    After `compress`, names are written with RFC 1035 compression: `names`
+    maps each lowercased name suffix already written to its offset, and
+    `pointers` lists where compression pointers were emitted.
+    """
+
+    __slots__ = ("buffer", "offset", "in_use", "names", "pointers")
+
+    def __init__(self, size: int = INITIAL_SIZE) -> None:
+        self.buffer = bytearray(size)
+        self.offset = 0
+        self.in_use = False
+        self.names: Optional[Dict[bytes, int]] = None
+        self.pointers: List[int] = []
+
+    def reset(self, compress: bool = False) -> None:
+        self.offset = 0
+        self.names = None
+        if compress:
+            self.compress()
+
+    def compress(self) -> None:
+        self.names = {}
+        self.pointers = []
+
+    def reserve(self, size: int) -> int:
+        """Make room for `size` more bytes and return the offset they start at."""
+        offset = self.offset
+        end = self.offset = offset + size
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end, 2 * len(self.buffer)) - len(self.buffer)))
+        return offset
+
+    def write(self, data: bytes) -> None:
+        offset = self.offset
+        end = self.offset = offset + len(data)
+        if end > len(self.buffer):
+            self.offset = offset
+            offset = self.reserve(len(data))
+        self.buffer[offset:end] = data
+
+    def write_struct(self, format: struct.Struct, *values: Any) -> None:
+        offset = self.offset
+        end = self.offset = offset + format.size
+        if end > len(self.buffer):
+            self.offset = offset
+            offset = self.reserve(format.size)
+        format.pack_into(self.buffer, offset, *values)
+
+    def write_name(self, name: str) -> None:
+        encoded = encode_labels(name, ".")
+        names = self.names
+        if names is None or len(encoded) == 1:
+            self.write(encoded)
+            return
+
+        # Find the longest suffix already in the message, remembering the
+        # ones in front of it for later names
+        key = encoded.lower()
+        start = self.offset
+        position = 0
+        while key[position]:
+            offset = names.get(key[position:])
+            if offset is not None:
+                self.write(encoded[:position])
+                self.pointers.append(self.offset)
+                self.write_struct(POINTER_STRUCT, POINTER_FLAG | offset)
+                break
+            if start + position <= MAX_POINTER:
+                names[key[position:]] = start + position
+            position += key[position] + 1
+        else:
+            self.write(encoded)
+
+    def write_email(self, email: str) -> None:
+        if "@" not in email:
+            raise ValueError("Invalid email: missing '@'")
+        self.write(encode_labels(email, "@"))
+
+    def getvalue(self) -> bytes:
+        return bytes(self.buffer[: self.offset])
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def encode_labels(text: str, separator: str) -> bytes:
+    """`text` split on `separator` as length-prefixed labels ending in a zero byte.
+
+    Cached: the same few owner and target names make up most responses.
+    """
+    text = text.rstrip(".")
+    if not text:
+        return b"\x00"
+    encoded = bytearray()
+    for label in text.encode().split(separator.encode()):
+        if len(label) > MAX_LABEL_LENGTH:
+            raise ValueError(f"Label exceeds {MAX_LABEL_LENGTH} bytes: {label!r}")
+        encoded.append(len(label))
+        encoded += label
+    encoded.append(0)
+    return bytes(encoded)
+
+
+_local = local()
+
+
+def encode(*items: Encodable, compress: bool = False) -> bytes:
+    """Encode `items` back to back with this thread's writer, as one message."""
+    writer: Optional[WireWriter] = getattr(_local, "writer", None)
+    if writer is None:
+        writer = _local.writer = WireWriter()
+    elif writer.in_use:
+        writer = WireWriter()  # re-entered from an item's own `write`
+    writer.in_use = True
+    writer.reset(compress)
+    try:
+        for item in items:
+            item.write(writer)
+        return writer.getvalue()
+    finally:
+        writer.in_use = False
@@ -1,7 +1,11 @@
 from ipaddress import IPv4Address
-from typing import List
-from dinodns.server import DinoDNS
+from typing import List, Optional
 from dinodns.catalog import Catalog
+from dinodns.pool import OverloadPolicy
+from dinodns.runner import ServerConfig, run_server
+from dinodns.supervisor import Supervisor
+from dinodns.tcp_server import DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_CONNECTIONS
+from dinodns.utils import parse_size
 import click
 import sys
 import logging
@@ -9,6 +13,13 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def parse_size_option(value: str) -> int:
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @click.command()
 @click.argument("CATALOG_FILE", type=click.Path(exists=True), required=True)
 @click.option(
@@ -28,12 +39,116 @@ logger = logging.getLogger(__name__)
     type=IPv4Address,
     help="Upstream DNS servers to forward unresolved queries to (e.g., --forward 8.8.8.8 --forward 1.1.1.1)",
 )
+@click.option(
+    "--race",
+    is_flag=True,
+    default=False,
+    help="Send each forwarded query to the two fastest upstreams and use the first valid reply",
+)
+@click.option(
+    "--stale-window",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Seconds expired forwarded answers are kept and served when upstreams fail, 0 to disable (default: 0)",
+)
+@click.option(
+    "--stale-answer-timeout",
+    type=click.FloatRange(min=0),
+    default=1.8,
+    help="Seconds to wait for upstreams before serving a stale answer (default: 1.8)",
+)
+@click.option(
+    "--prefetch",
+    type=click.FloatRange(min=0, max=1),
+    default=0.1,
+    help="Refresh popular forwarded answers in the background once this fraction of their TTL is left, 0 to disable (default: 0.1)",
+)
+@click.option(
+    "--cache-size",
+    callback=lambda _ctx, _param, value: parse_size_option(value),
+    default="64MB",
+    help="Memory budget of the forwarding cache, e.g. 256MB or 1GiB (default: 64MB)",
+)
+@click.option(
+    "--cache-snapshot",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="File the forwarding cache is saved to on shutdown and restored from at startup",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["async", "pool", "threads"]),
+    default="async",
+    help="UDP server engine: asyncio event loop, fixed worker pool, or one thread per query (default: async)",
+)
+@click.option(
+    "--pool-size",
+    type=click.IntRange(min=1),
+    default=32,
+    help="Worker threads of the pool engine (default: 32)",
+)
+@click.option(
+    "--queue-size",
+    type=click.IntRange(min=1),
+    default=1024,
+    help="Queries the pool engine may queue before shedding load (default: 1024)",
+)
+@click.option(
+    "--overload",
+    type=click.Choice([policy.value for policy in OverloadPolicy]),
+    default=OverloadPolicy.REFUSE.value,
+    help="What the pool engine does with queries when its queue is full (default: refuse)",
+)
+@click.option(
+    "--metrics-interval",
+    type=click.FLOAT,
+    default=60,
+    help="Seconds between metrics log lines, 0 to disable (default: 60)",
+)
+@click.option(
+    "--tcp/--no-tcp",
+    default=True,
+    help="Also serve DNS over TCP on the same address and port (default: on)",
+)
+@click.option(
+    "--tcp-idle-timeout",
+    type=click.FLOAT,
+    default=DEFAULT_IDLE_TIMEOUT,
+    help=f"Seconds a TCP connection may sit idle before it is closed (default: {DEFAULT_IDLE_TIMEOUT:g})",
+)
+@click.option(
+    "--tcp-max-connections",
+    type=click.INT,
+    default=DEFAULT_MAX_CONNECTIONS,
+    help=f"Open TCP connections allowed at once, per worker (default: {DEFAULT_MAX_CONNECTIONS})",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Server processes sharing the port through SO_REUSEPORT (default: 1)",
+)
 @click.option("--debug", is_flag=True, default=False, help="Enable debug mode")
 def main(
     catalog_file: click.Path,
     host: IPv4Address,
     port: int,
     upstreams: List[IPv4Address],
+    race: bool,
+    stale_window: int,
+    stale_answer_timeout: float,
+    prefetch: float,
+    cache_size: int,
+    cache_snapshot: Optional[str],
+    engine: str,
+    pool_size: int,
+    queue_size: int,
+    overload: str,
+    metrics_interval: float,
+    tcp: bool,
+    tcp_idle_timeout: float,
+    tcp_max_connections: int,
+    workers: int,
     debug: bool,
 ) -> None:
     log_level = logging.DEBUG if debug else logging.INFO
@@ -49,13 +164,34 @@ def main(
         datefmt="%Y-%m-%dT%H:%M:%S",
     )
 
-    try:
-        catalog = Catalog.from_file(catalog_file)
-        origins = [zone.origin for zone in catalog.zones]
-        logger.info(f'msg="Catalog loaded" zones={origins}')
+    config = ServerConfig(
+        catalog_file=str(catalog_file),
+        host=host,
+        port=port,
+        upstreams=list(upstreams),
+        race=race,
+        stale_window=stale_window,
+        stale_answer_timeout=stale_answer_timeout,
+        prefetch=prefetch,
+        cache_size=cache_size,
+        cache_snapshot=cache_snapshot,
+        engine=engine,
+        pool_size=pool_size,
+        queue_size=queue_size,
+        overload=OverloadPolicy(overload),
+        metrics_interval=metrics_interval,
+        tcp=tcp,
+        tcp_idle_timeout=tcp_idle_timeout,
+        tcp_max_connections=tcp_max_connections,
+    )
 
-        server = DinoDNS(host, port, catalog, upstreams)
-        server.start()
+    try:
+        if workers > 1:
+            # Fail fast on a broken catalog instead of crash-looping workers
+            Catalog.from_file(config.catalog_file)
+            Supervisor(config, workers).run()
+        else:
+            run_server(config)
     except Exception as e:
         logger.error(f'msg="DinoDNS Server failed" error="{e}"')
         sys.exit(1)
@@ -0,0 +1,97 @@
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Iterable, Optional
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Metrics merged across processes by averaging or by taking the largest value,
+# rather than by summing: ratios and round-trip times, and on/off flags
+MEAN_SUFFIXES = (".utilization", ".srtt")
+MAX_SUFFIXES = (".breaker_open",)
+
+
+class Metrics:
+    """Thread-safe counters plus gauges sampled when a snapshot is taken."""
+
+    def __init__(self) -> None:
+        self._counters: Dict[str, int] = {}
+        self._gauges: Dict[str, Callable[[], Optional[float]]] = {}
+        self._lock = Lock()
+
+    def inc(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name: str, sample: Callable[[], Optional[float]]) -> None:
+        """Register `sample`, read at each snapshot; a None reading is left out."""
+        with self._lock:
+            self._gauges[name] = sample
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            values: Dict[str, float] = dict(self._counters)
+            gauges = list(self._gauges.items())
+        for name, sample in gauges:
+            try:
+                value = sample()
+            except Exception as e:
+                logger.debug(f'msg="Gauge sampling failed" gauge={name} error="{e}"')
+                continue
+            if value is not None:
+                values[name] = value
+        return values
+
+
+def merge(snapshots: Iterable[Dict[str, float]]) -> Dict[str, float]:
+    totals: Dict[str, float] = {}
+    counts: Dict[str, int] = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            if name.endswith(MAX_SUFFIXES):
+                totals[name] = max(totals.get(name, value), value)
+            else:
+                totals[name] = totals.get(name, 0) + value
+            counts[name] = counts.get(name, 0) + 1
+    for name in totals:
+        if name.endswith(MEAN_SUFFIXES):
+            totals[name] /= counts[name]
+    return totals
+
+
+def log_metrics(values: Dict[str, float]) -> None:
+    logger.info(f'msg="Metrics" {to_logfmt(values)}')
+
+
+def to_logfmt(values: Dict[str, float]) -> str:
+    return " ".join(
+        f"{name}={round(value, 3) if isinstance(value, float) else value}"
+        for name, value in sorted(values.items())
+    )
+
+
+class MetricsReporter:
+    """Hands a metrics snapshot to `emit` (logfmt logging by default) every `interval` seconds."""
+
+    def __init__(
+        self,
+        sample: Callable[[], Dict[str, float]],
+        interval: float,
+        emit: Optional[Callable[[Dict[str, float]], None]] = None,
+    ) -> None:
+        self.sample = sample
+        self.interval = interval
+        self.emit = emit or log_metrics
+        self._stopped = Event()
+
+    def start(self) -> None:
+        if self.interval <= 0:
+            return
+        Thread(target=self._run, name="metrics-reporter", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.emit(self.sample())
@@ -0,0 +1,79 @@
+from enum import Enum
+from queue import Full, Queue
+from threading import Lock, Thread
+from typing import Any, Callable, Tuple
+from dinodns.metrics import Metrics
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class OverloadPolicy(Enum):
+    DROP = "drop"  # Silently discard queries the queue cannot hold
+    REFUSE = "refuse"  # Answer them with REFUSED so clients move on quickly
+
+
+class WorkerPool:
+    """Fixed set of handler threads fed by a bounded queue."""
+
+    def __init__(
+        self,
+        handler: Callable[[bytes, Any], None],
+        size: int,
+        queue_size: int,
+        metrics: Metrics,
+    ) -> None:
+        self.handler = handler
+        self.size = size
+        self.queue: "Queue[Tuple[bytes, Any]]" = Queue(maxsize=queue_size)
+        self.metrics = metrics
+        self._busy = 0
+        self._busy_seconds = 0.0
+        self._sampled_busy_seconds = 0.0
+        self._sampled_at = time.monotonic()
+        self._lock = Lock()
+
+        metrics.gauge("pool.queue_depth", self.queue.qsize)
+        metrics.gauge("pool.busy_workers", lambda: self._busy)
+        metrics.gauge("pool.utilization", self._utilization)
+
+    def start(self) -> None:
+        for i in range(self.size):
+            Thread(target=self._work, name=f"worker-{i}", daemon=True).start()
+        logger.info(
+            f'msg="Worker pool started" workers={self.size} queue_size={self.queue.maxsize}'
+        )
+
+    def submit(self, data: bytes, addr: Any) -> bool:
+        try:
+            self.queue.put_nowait((data, addr))
+            return True
+        except Full:
+            return False
+
+    def _work(self) -> None:
+        while True:
+            data, addr = self.queue.get()
+            started = time.monotonic()
+            with self._lock:
+                self._busy += 1
+            try:
+                self.handler(data, addr)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self._busy_seconds += time.monotonic() - started
+
+    def _utilization(self) -> float:
+        """Share of worker time spent handling queries since the last sample."""
+        now = time.monotonic()
+        with self._lock:
+            busy = self._busy_seconds - self._sampled_busy_seconds
+            elapsed = now - self._sampled_at
+            self._sampled_busy_seconds = self._busy_seconds
+            self._sampled_at = now
+        if elapsed <= 0:
+            return 0.0
+        return min(1.0, busy / (elapsed * self.size))
@@ -1,63 +1,72 @@
-from typing import List, Optional
-from dinodns.catalog import Catalog
-from dinodns.core.message import DNSMessage
-from dinodns.core.question import DNSQuestion, QClass, QType
-from dinodns.core.rr.resource_record import (
-    DNSResourceRecord,
+from typing import Optional
+from dinodns.compiled import EMPTY_SECTIONS, CompiledCatalog
+from dinodns.core.edns import OPT_RECORD, truncated
+from dinodns.core.header import (
+    AA_BIT,
+    CD_BIT,
+    OPCODE_MASK,
+    QR_BIT,
+    RA_BIT,
+    RD_BIT,
+    RCode,
 )
+from dinodns.core.query import QueryView
+from dinodns.zone_tree import LookupStatus
+import struct
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
-def try_glue_resource_record(
-    catalog: Catalog, rr: DNSResourceRecord
-) -> "Optional[DNSResourceRecord]":
-    if not rr.requires_glue_record():
-        return None
+def try_resolve_query(compiled: CompiledCatalog, query: QueryView) -> Optional[bytes]:
+    question = query.question
+    raw_question = query.raw_question
 
-    domain_name = rr.rdata.domain_name_target
-    if not domain_name:
+    result = compiled.catalog.lookup(question)
+    if result.status == LookupStatus.NOTAUTH:
         return None
 
-    glue_question = DNSQuestion(
-        qname=domain_name,
-        qtype=QType.A,
-        qclass=QClass.IN,
+    sections = EMPTY_SECTIONS
+    flags = QR_BIT | RA_BIT | AA_BIT
+
+    if result.status == LookupStatus.ANSWER and result.rrset:
+        rrset = compiled.rrset(result.rrset)
+        if result.wildcard:
+            # Synthesize the owner from the query name, as sent
+            sections = rrset.synthesized()
+        else:
+            sections = rrset.answer
+
+    elif result.status == LookupStatus.DELEGATION and result.rrset:
+        sections = compiled.rrset(result.rrset).referral
+        # Referrals are not authoritative
+        flags &= ~AA_BIT
+
+    elif result.zone:
+        sections = compiled.negative(result.zone)
+        if result.status == LookupStatus.NXDOMAIN:
+            flags |= RCode.NXDOMAIN.value
+
+    # CD is copied into the response (RFC 4035 section 3.1.6)
+    flags |= query.flags & (OPCODE_MASK | RD_BIT | CD_BIT)
+
+    response = b"".join(
+        (
+            struct.pack(
+                "!HHHHHH",
+                query.id,
+                flags,
+                1,
+                sections.ancount,
+                sections.nscount,
+                sections.arcount + query.edns,
+            ),
+            raw_question,
+            sections.for_question(raw_question),
+            OPT_RECORD if query.edns else b"",
+        )
     )
-
-    resolved = catalog.try_lookup_record(glue_question)
-    if not resolved:
-        logger.warning(f'msg="No record found for {glue_question.qname}"')
-        return None
-
-    record, origin = resolved
-    return DNSResourceRecord.from_record(record, origin)
-
-
-def try_resolve_query(catalog: Catalog, query: DNSMessage) -> bool:
-    question = query.questions[0]
-
-    resolved = catalog.try_lookup_record(question)
-    if not resolved:
-        return False
-
-    record, origin = resolved
-
-    answers: List[DNSResourceRecord] = []
-    additional: List[DNSResourceRecord] = []
-
-    rr = DNSResourceRecord.from_record(record, origin)
-    answers.append(rr)
-
-    glue_rr = try_glue_resource_record(catalog, rr)
-    if glue_rr:
-        additional.append(glue_rr)
-
-    query.promote_to_response(recursion_supported=True)
-    query.header.flags.aa = 1  # Authoritative Answer
-    query.set_answers(answers)
-    query.set_additional(additional)
-
-    return True
+    if len(response) > query.payload:
+        return truncated(response, query.question_end, query.edns)
+    return response
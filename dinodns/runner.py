@@ -0,0 +1,105 @@
+from dataclasses import dataclass
+from ipaddress import IPv4Address
+from typing import Callable, Dict, List, Optional
+from dinodns import async_server, snapshot
+from dinodns.catalog import Catalog
+from dinodns.metrics import MetricsReporter
+from dinodns.pool import OverloadPolicy
+from dinodns.server import DinoDNS
+from dinodns.tcp_server import TCPServer
+from threading import Thread
+import signal
+import sys
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ServerConfig:
+    catalog_file: str
+    host: IPv4Address
+    port: int
+    upstreams: List[IPv4Address]
+    race: bool
+    stale_window: int
+    stale_answer_timeout: float
+    prefetch: float
+    cache_size: int
+    cache_snapshot: Optional[str]
+    engine: str
+    pool_size: int
+    queue_size: int
+    overload: OverloadPolicy
+    metrics_interval: float
+    tcp: bool
+    tcp_idle_timeout: float
+    tcp_max_connections: int
+
+
+def reload_catalog(server: DinoDNS, catalog_file: str) -> None:
+    """Swap in the catalog file's current contents, keeping the old catalog if they are broken."""
+    try:
+        server.reload_catalog(Catalog.from_file(catalog_file))
+    except Exception as e:
+        logger.error(
+            f'msg="Catalog reload failed, keeping the current catalog" file="{catalog_file}" error="{str(e) or type(e).__name__}"'
+        )
+
+
+def run_server(
+    config: ServerConfig,
+    reuse_port: bool = False,
+    emit_metrics: Optional[Callable[[Dict[str, float]], None]] = None,
+) -> None:
+    catalog = Catalog.from_file(config.catalog_file)
+    origins = [zone.origin for zone in catalog.zones]
+    logger.info(f'msg="Catalog loaded" zones={origins}')
+
+    server = DinoDNS(
+        config.host,
+        config.port,
+        catalog,
+        config.upstreams,
+        reuse_port=reuse_port,
+        race=config.race,
+        stale_window=config.stale_window,
+        stale_answer_timeout=config.stale_answer_timeout,
+        prefetch=config.prefetch,
+        cache_size=config.cache_size,
+    )
+    signal.signal(
+        signal.SIGHUP,
+        lambda *_: reload_catalog(server, config.catalog_file),
+    )
+    # Unwind through the finally below so the cache snapshot gets written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    MetricsReporter(server.metrics.snapshot, config.metrics_interval, emit_metrics).start()
+
+    if config.cache_snapshot:
+        # A large snapshot takes seconds to restore: answer queries meanwhile
+        Thread(
+            target=snapshot.load,
+            args=(server.cache, config.cache_snapshot),
+            name="cache-snapshot",
+            daemon=True,
+        ).start()
+    tcp = (
+        TCPServer(server, config.tcp_idle_timeout, config.tcp_max_connections)
+        if config.tcp
+        else None
+    )
+    try:
+        if config.engine == "async":
+            async_server.start(server, tcp)
+        else:
+            if tcp is not None:
+                tcp.start_background()
+            if config.engine == "pool":
+                server.start_pool(config.pool_size, config.queue_size, config.overload)
+            else:
+                server.start()
+    finally:
+        if config.cache_snapshot:
+            snapshot.save(server.cache, config.cache_snapshot)
@@ -1,18 +1,48 @@
 from ipaddress import IPv4Address
-from socket import AF_INET, SOCK_DGRAM, socket
-from typing import Any, Optional
-from dinodns.cache import DNSCache
-from dinodns.core.header import OpCode, RCode
+from socket import AF_INET, SOCK_DGRAM, SO_RCVBUF, SO_REUSEPORT, SOL_SOCKET, socket
+from typing import Any, List, Optional, Union
+from dinodns.cache import (
+    DEFAULT_CACHE_BYTES,
+    CacheKey,
+    PacketCache,
+    ShardedDNSCache,
+    cacheable,
+)
+from dinodns.compiled import CompiledCatalog
+from dinodns.core.edns import EDNS_VERSION, PAYLOAD_SIZE
+from dinodns.core.header import Z_MASK, DNSHeader, OpCode, RCode
 from dinodns.core.message import DNSMessage
+from dinodns.core.query import QueryView, parse_query
 from dinodns.catalog import Catalog
 from dinodns.core.question import QClass
+from dinodns.core.rr.classes import Class
+from dinodns.core.rr.rdata.opt import RDataOPT
+from dinodns.core.rr.types import Type
+from dinodns.metrics import Metrics
+from dinodns.pool import OverloadPolicy, WorkerPool
 from dinodns.resolver import try_resolve_query
+from dinodns.singleflight import SingleFlight
+from dinodns.steps import Spawn, Steps, Wait, run
+from dinodns.upstream import (
+    MAX_RTO,
+    TCP_TIMEOUT,
+    Address,
+    UpstreamManager,
+    is_truncated,
+)
+from dinodns.utils import skip_domain_name
+import struct
 import threading
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+# Queries are small; this leaves room for any EDNS options clients attach
+MAX_QUERY_SIZE = 4096
+UPSTREAM_PORT = 53
+
 
 class DinoDNS:
     def __init__(
@@ -21,15 +51,82 @@ class DinoDNS:
         port: int,
         catalog: Catalog,
         upstreams: list[IPv4Address] = [],
+        reuse_port: bool = False,
+        race: bool = False,
+        stale_window: int = 0,
+        stale_answer_timeout: float = 1.8,
+        prefetch: float = 0.0,
+        cache_size: int = DEFAULT_CACHE_BYTES,
+        upstream_port: int = UPSTREAM_PORT,
     ):
         self.host = host
         self.port = port
         self.catalog = catalog
+        self.compiled = CompiledCatalog(catalog)
         self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.reuse_port = reuse_port
         self.upstreams = upstreams
-        self.cache = DNSCache(max_size=1000, enable_logging=True)
+        self.upstream_port = upstream_port
+        self.race = race
+        self.cache = ShardedDNSCache(
+            max_bytes=cache_size,
+            enable_logging=True,
+            stale_window=stale_window,
+            prefetch_fraction=prefetch,
+        )
+        # How long a client with a stale answer on hand waits for a fresh one
+        self.stale_answer_timeout = stale_answer_timeout
+        self.packet_cache = PacketCache()
+        self.flights: SingleFlight[bytes] = SingleFlight()
+        # Longest a coalesced query waits for its leader to try every upstream
+        # and fetch a truncated answer again over TCP
+        self.flight_timeout = MAX_RTO * max(len(upstreams), 1) + TCP_TIMEOUT + 1
+        self.metrics = Metrics()
+        self.upstream_manager = UpstreamManager(self.metrics)
+        self.metrics.gauge("packet_cache.entries", lambda: len(self.packet_cache))
+        self.metrics.gauge("packet_cache.hits", lambda: self.packet_cache.hits)
+        self.metrics.gauge("packet_cache.misses", lambda: self.packet_cache.misses)
+        self.metrics.gauge(
+            "packet_cache.evictions", lambda: self.packet_cache.evictions
+        )
+        self.metrics.gauge("forward.in_flight", lambda: len(self.flights))
+        self.metrics.gauge("upstream.pending", self.upstream_manager.pending)
+        self.metrics.gauge("cache.entries", lambda: len(self.cache))
+        self.metrics.gauge("cache.bytes", lambda: self.cache.bytes)
+        self.metrics.gauge("cache.evictions", lambda: self.cache.evictions)
+        self.metrics.gauge("cache.hits", lambda: self.cache.hits)
+        self.metrics.gauge("cache.misses", lambda: self.cache.misses)
+        for upstream in upstreams:
+            source = str(upstream)
+            self.metrics.gauge(
+                f"upstream.{source}.cache_hits",
+                lambda source=source: self.cache.hits_by_source.get(source, 0),
+            )
+            address = (source, upstream_port)
+            self.metrics.gauge(
+                f"upstream.{source}.srtt",
+                lambda address=address: self.upstream_manager.sample(
+                    address, lambda upstream: upstream.rtt.srtt
+                ),
+            )
+            self.metrics.gauge(
+                f"upstream.{source}.breaker_open",
+                lambda address=address: self.upstream_manager.sample(
+                    address, lambda upstream: int(not upstream.available)
+                ),
+            )
 
-    def start(self) -> None:
+    def reload_catalog(self, catalog: Catalog) -> None:
+        compiled = CompiledCatalog(catalog)
+        self.catalog, self.compiled = catalog, compiled
+        logger.info(f'msg="Catalog reloaded" {catalog}')
+
+    def bind(self) -> None:
+        # Absorb bursts instead of letting the kernel drop datagrams
+        self.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        if self.reuse_port:
+            # Lets the kernel spread datagrams across every worker process
+            self.socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.socket.bind((str(self.host), self.port))
         logger.info(f'msg="Server listening on {self.host}:{self.port}"')
 
@@ -40,9 +137,12 @@ class DinoDNS:
             f'msg="Forwarding to upstream resolvers" upstreams={[str(ip) for ip in self.upstreams]}'
         )
 
+    def start(self) -> None:
+        self.bind()
+
         while True:
             try:
-                data, addr = self.socket.recvfrom(512)
+                data, addr = self.socket.recvfrom(MAX_QUERY_SIZE)
                 threading.Thread(
                     target=self.handle_client, args=(data, addr), daemon=True
                 ).start()
@@ -50,38 +150,110 @@ class DinoDNS:
                 logger.info('msg="Shutting down"')
                 break
 
+    def start_pool(
+        self, size: int, queue_size: int, overload: OverloadPolicy
+    ) -> None:
+        self.bind()
+        pool = WorkerPool(self.handle_client, size, queue_size, self.metrics)
+        pool.start()
+
+        while True:
+            try:
+                data, addr = self.socket.recvfrom(MAX_QUERY_SIZE)
+                if not pool.submit(data, addr):
+                    self.shed(data, addr, overload)
+            except KeyboardInterrupt:
+                logger.info('msg="Shutting down"')
+                break
+
+    def shed(self, data: bytes, addr: Any, overload: OverloadPolicy) -> None:
+        if overload == OverloadPolicy.REFUSE:
+            response = self.refused(data)
+            if response is not None:
+                self.metrics.inc("pool.refused")
+                self.socket.sendto(response, addr)
+                return
+        self.metrics.inc("pool.dropped")
+
+    @staticmethod
+    def refused(data: bytes) -> Optional[bytes]:
+        """Build a REFUSED reply straight from the request bytes."""
+        try:
+            id, flags, qdcount = struct.unpack_from("!HHH", data)
+            question_end = (
+                skip_domain_name(data, DNSHeader.HEADER_SIZE) + 4 if qdcount else 12
+            )
+        except (IndexError, struct.error):
+            return None
+        if question_end > len(data):
+            return None
+        flags = 0x8000 | (flags & 0x7900) | RCode.REFUSED.value  # keep opcode and RD
+        header = struct.pack("!HHHHHH", id, flags, min(qdcount, 1), 0, 0, 0)
+        return header + data[DNSHeader.HEADER_SIZE : question_end]
+
     def handle_client(self, data: bytes, addr: Any) -> None:
         try:
-            query = self.decode_query(data)
-            response = self.handle_query(query)
+            response = self.packet_cache.get(data, self.compiled)
+            if response is None:
+                query = self.decode_query(data)
+                response = (
+                    query if isinstance(query, bytes) else self.handle_query(query)
+                )
             self.socket.sendto(response, addr)
         except Exception as e:
             logger.error(f'msg="Error handling client query: {e}" addr={addr}"')
 
-    def decode_query(self, data: bytes) -> DNSMessage:
-        return DNSMessage.from_bytes(data, 0)
+    def decode_query(self, data: bytes) -> Union[QueryView, bytes]:
+        """Decode a query to resolve, or reply at once to one we cannot serve.
+
+        Plain queries only have their header and question read; anything
+        else goes through the full parser and feature checks.
+        """
+        query = parse_query(data)
+        if query is not None:
+            return query
 
-    def handle_query(self, query: DNSMessage) -> bytes:
-        if rcode := self.check_unsupported_features(query):
-            query.header.flags.rcode = rcode
-            return query.to_bytes()
+        message = DNSMessage.from_bytes(data, 0)
+        if rcode := self.check_unsupported_features(message):
+            message.header.flags.rcode = rcode
+            opt = message.opt()
+            if opt is not None:
+                # Our OPT carries the upper bits of extended codes like BADVERS
+                opt.class_ = Class(PAYLOAD_SIZE)
+                opt.ttl = (rcode.value >> 4) << 24 | EDNS_VERSION << 16
+                opt.rdata = RDataOPT(options=b"")
+            response = message.to_bytes()
+            self.packet_cache.set(data, response, self.compiled)
+            return response
 
-        if not query.is_query():
-            return query.to_bytes()
+        if not message.is_query():
+            return message.to_bytes()
 
-        return self.try_resolve_or_forward(query)
+        return QueryView.from_message(message, data)
 
-    def try_resolve_or_forward(self, query: DNSMessage) -> bytes:
-        resolved = try_resolve_query(self.catalog, query)
-        if resolved:
-            return query.to_bytes()
+    def handle_query(self, query: QueryView) -> bytes:
+        response = self.try_answer_locally(query)
+        if response is not None:
+            return response
 
         forwarded = self.forward_query(query)
         if forwarded:
             return forwarded
 
-        query.header.flags.rcode = RCode.SERVFAIL
-        return query.to_bytes()
+        return self.servfail(query)
+
+    def try_answer_locally(self, query: QueryView) -> Optional[bytes]:
+        """Answer from the catalog, or None if forwarding is needed."""
+        compiled = self.compiled
+        resolved = try_resolve_query(compiled, query)
+        # The packet cache serves UDP, where the same request may need truncating
+        if resolved and not query.tcp:
+            self.packet_cache.set(query.data, resolved, compiled)
+        return resolved
+
+    @staticmethod
+    def servfail(query: QueryView) -> bytes:
+        return query.with_rcode(RCode.SERVFAIL)
 
     @staticmethod
     def check_unsupported_features(message: DNSMessage) -> Optional[RCode]:
@@ -95,7 +267,8 @@ class DinoDNS:
             )
             return RCode.NOTIMP
 
-        if message.header.flags.z != 0:
+        # AD and CD share the legacy Z field and pass through
+        if message.header.flags.to_int() & Z_MASK:
             logger.warning('msg="Z flag must be zero (reserved)"')
             return RCode.FORMERR
 
@@ -110,38 +283,178 @@ class DinoDNS:
             logger.warning(f'msg="Unsupported QClass: {question.qclass.name}"')
             return RCode.NOTIMP
 
+        opts = [rr for rr in message.additional if rr.type == Type.OPT]
+        if len(opts) > 1 or (opts and opts[0].name != "."):
+            logger.warning('msg="Malformed OPT record"')
+            return RCode.FORMERR
+
+        if opts and (opts[0].ttl >> 16) & 0xFF != EDNS_VERSION:
+            logger.warning(
+                f'msg="Unsupported EDNS version: {(opts[0].ttl >> 16) & 0xFF}"'
+            )
+            return RCode.BADVERS
+
         return None
 
-    def forward_query(self, query: DNSMessage, port: int = 53) -> Optional[bytes]:
-        raw_query: bytes = query.to_bytes()
+    @staticmethod
+    def forward_cache_key(query: QueryView) -> CacheKey:
+        # Any upstream's answer serves every client asking the same question
+        # with the same RD and CD bits
+        q = query.question
+        return (
+            q.qname.rstrip(".").lower(),
+            q.qtype.value,
+            q.qclass.value,
+            query.rd,
+            query.cd,
+        )
+
+    def cache_forwarded(
+        self, key: CacheKey, response: bytes, upstream: IPv4Address
+    ) -> bytes:
+        """Cache a forwarded response and return it as clients should see it."""
+        self.metrics.inc(f"upstream.{upstream}.answers")
+        scanned = cacheable(response)
+        if scanned is None:
+            logger.info(f'msg="Forwarded, not cacheable" key={key}')
+            return response
+        response, ttl, ttl_offsets = scanned
+        self.cache.set(key, response, ttl, ttl_offsets, source=str(upstream))
+        logger.info(f'msg="Forwarded and cached for {key}" ttl={ttl}')
+        return response
+
+    def forward_query(self, query: QueryView) -> Optional[bytes]:
+        return run(self.forward_steps(query))
+
+    def forward_steps(self, query: QueryView) -> Steps[Optional[bytes]]:
+        """Answer from the forwarding cache or the upstreams, coalescing identical misses.
+
+        Shared by every engine; the engine only supplies the waiting.
+        """
+        key = self.forward_cache_key(query)
+        raw_query = query.upstream_query()
+
+        cached = self.cache.get(key)
+        if cached:
+            logger.info(f'msg="Cache hit for {key}"')
+            if self.cache.claim_prefetch(key):
+                yield from self.prefetch_steps(key, raw_query)
+            return reply_for(query, cached)
+
+        stale = self.cache.get_stale(key)
+        flight, leader = self.flights.join(key)
+        if not leader:
+            self.metrics.inc("forward.coalesced")
+        elif stale is None:
+            yield from self.resolve_steps(key, raw_query)
+        else:
+            # Refresh in the background so the stale answer can go out on time
+            yield Spawn(self.resolve_steps(key, raw_query))
 
-        for upstream in self.upstreams:
-            q = query.questions[0]
-            key = (q.qname.rstrip(".").lower(), q.qtype.name, str(upstream))
+        try:
+            response = yield Wait(
+                flight,
+                self.flight_timeout if stale is None else self.stale_answer_timeout,
+            )
+        except TimeoutError:
+            response = None
+        return self.reply_or_stale(key, query, response, stale)
 
-            cached = self.cache.get(key)
-            if cached:
-                logger.info(f'msg="Cache hit for {key}"')
-                response = bytearray(cached)
-                response[0:2] = query.to_bytes()[0:2]  # patch transaction ID
-                return bytes(response)
+    def prefetch_steps(self, key: CacheKey, raw_query: bytes) -> Steps[None]:
+        _, leader = self.flights.join(key)
+        if not leader:
+            return  # already being refreshed
+        self.metrics.inc("cache.prefetches")
+        logger.debug(f'msg="Prefetching" key={key}')
+        yield Spawn(self.resolve_steps(key, raw_query))
+
+    def resolve_steps(self, key: CacheKey, raw_query: bytes) -> Steps[None]:
+        response = None
+        try:
+            response = yield from self.upstream_steps(key, raw_query)
+        finally:
+            self.flights.finish(key, response)
+
+    def reply_or_stale(
+        self,
+        key: CacheKey,
+        query: QueryView,
+        response: Optional[bytes],
+        stale: Optional[bytes],
+    ) -> Optional[bytes]:
+        if response:
+            return reply_for(query, response)
+        if stale:
+            self.metrics.inc("cache.stale_answers")
+            logger.info(f'msg="Serving stale answer" key={key}')
+            return reply_for(query, stale)
+        return None
 
+    def upstream_attempts(self) -> List[List[Address]]:
+        """Upstreams to try in turn, fastest first; in race mode the two best go together.
+
+        An upstream due a trial query after its breaker opened comes first,
+        on its own, so its answer alone decides whether the breaker closes.
+        """
+        addresses = [
+            (str(upstream), self.upstream_port) for upstream in self.upstreams
+        ]
+        attempts = [[address] for address in self.upstream_manager.trials(addresses)]
+        ranked = self.upstream_manager.rank(addresses)
+        if self.race and len(ranked) > 1:
+            attempts.append(ranked[:2])
+            ranked = ranked[2:]
+        attempts.extend([address] for address in ranked)
+        if addresses and not attempts:
+            # Every breaker is open with no trial due: fail at once, so a
+            # stale answer or SERVFAIL goes out instead of waiting on a timeout
+            self.metrics.inc("forward.unavailable")
+        return attempts
+
+    def upstream_steps(self, key: CacheKey, raw_query: bytes) -> Steps[Optional[bytes]]:
+        attempts = self.upstream_attempts()
+        for index, addresses in enumerate(attempts):
             try:
-                with socket(AF_INET, SOCK_DGRAM) as s:
-                    s.settimeout(2)
-                    s.sendto(raw_query, (str(upstream), port))
-                    response_data, _ = s.recvfrom(512)
+                exchange = self.upstream_manager.exchange(
+                    addresses, raw_query, last=index == len(attempts) - 1
+                )
+                try:
+                    (ip, port), response_data = yield Wait(
+                        exchange.future, exchange.timeout
+                    )
+                except TimeoutError:
+                    exchange.expire()
+                    raise
 
-                    # TODO : to improve, extract the actual TTL from the DNS response
-                    ttl: int = 3600
-                    self.cache.set(key, response_data, ttl)
+                if is_truncated(response_data):
+                    # Cached answers serve TCP clients too, so fetch all of it
+                    self.metrics.inc("forward.tcp_retries")
+                    response_data = yield Wait(
+                        self.upstream_manager.tcp_query((ip, port), raw_query),
+                        TCP_TIMEOUT,
+                    )
 
-                    logger.info(f'msg="Forwarded and cached for {key}"')
-                    return response_data
+                return self.cache_forwarded(key, response_data, IPv4Address(ip))
 
             except Exception as e:
+                upstreams = ",".join(ip for ip, _ in addresses)
                 logger.warning(
-                    f'msg="Forwarding failed" upstream="{str(upstream)}" error="{e}"'
+                    f'msg="Forwarding failed" upstream="{upstreams}" error="{str(e) or type(e).__name__}"'
                 )
 
         return None
+
+
+def reply_for(query: QueryView, response: bytes) -> bytes:
+    """Adapt a response produced for another client to this query.
+
+    Patches the transaction ID, echoes this query's question, which may
+    differ from the one the response was built for in letter case only,
+    and fits the response to the client's EDNS payload size.
+    """
+    raw_query = query.data
+    start, end = DNSHeader.HEADER_SIZE, query.question_end
+    question = raw_query[start:end]
+    if response[start:end].lower() != question.lower():
+        return query.fit(raw_query[0:2] + response[2:])
+    return query.fit(raw_query[0:2] + response[2:start] + question + response[end:])
@@ -0,0 +1,37 @@
+from concurrent.futures import Future
+from threading import Lock
+from typing import Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """Collapses concurrent work on the same key into one in-flight call.
+
+    The first caller for a key becomes the leader and must call `finish`;
+    everyone else waits on the returned future. Futures are
+    `concurrent.futures.Future` so both threads and asyncio tasks (through
+    `asyncio.wrap_future`) can wait on them.
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[Hashable, "Future[Optional[T]]"] = {}
+        self._lock = Lock()
+
+    def join(self, key: Hashable) -> Tuple["Future[Optional[T]]", bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Future()
+            return flight, True
+
+    def finish(self, key: Hashable, result: Optional[T]) -> None:
+        with self._lock:
+            flight = self._flights.pop(key, None)
+        if flight is not None and flight.set_running_or_notify_cancel():
+            flight.set_result(result)
+
+    def __len__(self) -> int:
+        return len(self._flights)
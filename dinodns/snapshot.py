@@ -0,0 +1,177 @@
+from itertools import accumulate
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from dinodns.cache import CacheEntry, CacheKey, DNSCache, ShardedDNSCache
+import gc
+import os
+import struct
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MAGIC = b"DINOSNAP"
+VERSION = 2
+# magic, version, entry count, upstream count, byte size of the qname text
+HEADER = struct.Struct("!8sHIHQ")
+# The upstreams follow the header, each as a length byte and its name. Then
+# come the per-entry fields, each stored as one column holding every entry's
+# value: expiry, stored_at, qname length in characters, qtype, qclass, rd, cd,
+# upstream (1-based, 0 for none), TTL offset count, response length. The
+# qnames, TTL offsets and responses follow, each as one run, so loading
+# unpacks a field for all entries at once instead of entry by entry.
+COLUMNS = "ddHHHBBHHI"
+
+
+def save(cache: Union[DNSCache, ShardedDNSCache], path: str) -> int:
+    """Write every cache entry to `path`, replacing it atomically."""
+    entries = cache.entries()
+    keys = [key for key, _ in entries]
+    values = [entry for _, entry in entries]
+    qnames = [qname for qname, *_ in keys]
+    upstreams: Dict[Optional[str], int] = {None: 0}
+    columns = (
+        [entry.expiry for entry in values],
+        [entry.stored_at for entry in values],
+        list(map(len, qnames)),
+        *list(zip(*keys))[1:],
+        [upstreams.setdefault(entry.source, len(upstreams)) for entry in values],
+        [len(entry.ttl_offsets) for entry in values],
+        [len(entry.response) for entry in values],
+    )
+    del upstreams[None]
+    name_text = "".join(qnames).encode()
+    ttl_offsets = [offset for entry in values for offset in entry.ttl_offsets]
+
+    try:
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC, VERSION, len(entries), len(upstreams), len(name_text)
+                )
+            )
+            for upstream in upstreams:
+                name = upstream.encode()
+                f.write(bytes([len(name)]) + name)
+            if entries:
+                for code, column in zip(COLUMNS, columns):
+                    f.write(struct.pack(f"!{len(column)}{code}", *column))
+            f.write(name_text)
+            f.write(struct.pack(f"!{len(ttl_offsets)}H", *ttl_offsets))
+            f.write(b"".join(entry.response for entry in values))
+        os.replace(temporary, path)
+    except (OSError, ValueError, struct.error) as e:
+        logger.error(f'msg="Cache snapshot failed" path="{path}" error="{e}"')
+        return 0
+    logger.info(f'msg="Cache snapshot saved" path="{path}" entries={len(entries)}')
+    return len(entries)
+
+
+def split(sequence: Sequence[T], lengths: Iterable[int], start: int = 0) -> List[T]:
+    """Consecutive slices of `sequence` with the given lengths, from `start` on."""
+    bounds = list(accumulate(lengths, initial=start))
+    if bounds[-1] > len(sequence):
+        raise ValueError("truncated cache snapshot")
+    return list(map(sequence.__getitem__, map(slice, bounds, bounds[1:])))
+
+
+def read(data: bytes) -> List[Tuple[CacheKey, CacheEntry]]:
+    magic, version, count, upstream_count, names_size = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"not a version {VERSION} cache snapshot")
+    offset = HEADER.size
+    upstreams: List[Optional[str]] = [None]
+    for _ in range(upstream_count):
+        length = data[offset]
+        upstreams.append(data[offset + 1 : offset + 1 + length].decode())
+        offset += 1 + length
+    if not count:
+        return []
+
+    # Snapshots hold up to millions of entries: each step below handles all
+    # of them inside one C loop (unpack, map, zip) instead of Python bytecode
+    columns: List[Tuple[Any, ...]] = []
+    for code in COLUMNS:
+        column = struct.Struct(f"!{count}{code}")
+        columns.append(column.unpack_from(data, offset))
+        offset += column.size
+    (
+        expiries,
+        stored_ats,
+        name_lengths,
+        qtypes,
+        qclasses,
+        rds,
+        cds,
+        sources,
+        ttl_counts,
+        response_lengths,
+    ) = columns
+    qnames = split(str(data[offset : offset + names_size], "utf-8"), name_lengths)
+    offset += names_size
+    ttl_format = struct.Struct(f"!{sum(ttl_counts)}H")
+    ttl_offsets = split(ttl_format.unpack_from(data, offset), ttl_counts)
+    offset += ttl_format.size
+    responses = split(data, response_lengths, offset)
+
+    return list(
+        zip(
+            zip(qnames, qtypes, qclasses, rds, cds),
+            map(
+                CacheEntry,
+                responses,
+                expiries,
+                stored_ats,
+                ttl_offsets,
+                map(upstreams.__getitem__, sources),
+            ),
+        )
+    )
+
+
+def load(cache: Union[DNSCache, ShardedDNSCache], path: str) -> int:
+    """Restore entries saved by `save`; remaining TTLs carry on from the wall clock."""
+    started = time.monotonic()
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        logger.info(f'msg="No cache snapshot to load" path="{path}"')
+        return 0
+    except OSError as e:
+        logger.warning(f'msg="Cache snapshot unreadable" path="{path}" error="{e}"')
+        return 0
+
+    # Millions of small allocations would otherwise trigger repeated
+    # collections that cost as much as the parsing itself
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        entries = read(data)
+        before = len(cache)
+        cache.restore(entries)
+    except (ValueError, IndexError, UnicodeDecodeError, struct.error) as e:
+        logger.warning(f'msg="Cache snapshot ignored" path="{path}" error="{e}"')
+        return 0
+    finally:
+        if collecting:
+            gc.enable()
+
+    loaded = len(cache) - before
+    logger.info(
+        f'msg="Cache snapshot loaded" path="{path}" entries={loaded} expired={len(entries) - loaded} duration={time.monotonic() - started:.3f}s'
+    )
+    return loaded
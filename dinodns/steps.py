@@ -0,0 +1,51 @@
+from concurrent.futures import Future
+from dataclasses import dataclass
+from threading import Thread
+from typing import Any, Generator, Optional, TypeVar, Union
+
+
+T = TypeVar("T")
+
+
+@dataclass(slots=True)
+class Wait:
+    """Resume with `future`'s result, or with TimeoutError after `timeout` seconds.
+
+    Timing out leaves the future alone: other queries may share it, and the
+    steps decide what to cancel.
+    """
+
+    future: "Future[Any]"
+    timeout: float
+
+
+@dataclass(slots=True)
+class Spawn:
+    """Run `steps` in the background and resume at once."""
+
+    steps: "Steps[Any]"
+
+
+Step = Union[Wait, Spawn]
+# Engine-neutral work such as forwarding a query: a generator yielding what it
+# waits on, driven by `run` on a thread or async_server.run_async on an event loop
+Steps = Generator[Step, Any, T]
+
+
+def run(steps: Steps[T]) -> T:
+    """Drive `steps` on the calling thread, background steps on threads of their own."""
+    outcome: Any = None
+    error: Optional[Exception] = None
+    while True:
+        try:
+            step = steps.send(outcome) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        outcome, error = None, None
+        if isinstance(step, Spawn):
+            Thread(target=run, args=(step.steps,), daemon=True).start()
+            continue
+        try:
+            outcome = step.future.result(timeout=step.timeout)
+        except Exception as e:
+            error = e
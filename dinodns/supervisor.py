@@ -0,0 +1,146 @@
+from dataclasses import replace
+from multiprocessing.process import BaseProcess
+from queue import Empty
+from typing import Any, Dict, List, Optional
+from dinodns.metrics import log_metrics, merge
+from dinodns.runner import ServerConfig, run_server
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+RESTART_BACKOFF_MIN = 1.0
+RESTART_BACKOFF_MAX = 30.0
+# A worker that lived this long before dying is considered healthy again
+STABLE_UPTIME = 60.0
+
+
+def run_worker(config: ServerConfig, index: int, metrics_queue: Any) -> None:
+    # Ctrl+C reaches the whole process group; the supervisor owns shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logger.info(f'msg="Worker started" worker={index} pid={os.getpid()}')
+    if config.cache_snapshot:
+        # Each worker has its own cache, so each keeps its own snapshot
+        config = replace(config, cache_snapshot=f"{config.cache_snapshot}.{index}")
+    try:
+        run_server(
+            config,
+            reuse_port=True,
+            emit_metrics=lambda values: metrics_queue.put((index, values)),
+        )
+    except Exception as e:
+        logger.error(f'msg="Worker failed" worker={index} error="{e}"')
+        sys.exit(1)
+
+
+class Supervisor:
+    """Forks one server per worker on a shared SO_REUSEPORT address and keeps them alive."""
+
+    def __init__(self, config: ServerConfig, workers: int) -> None:
+        self.config = config
+        self.workers = workers
+        self.context = multiprocessing.get_context("fork")
+        self.metrics_queue = self.context.Queue()
+        self.processes: List[Optional[BaseProcess]] = [None] * workers
+        self.started_at: List[float] = [0.0] * workers
+        self.backoff: List[float] = [RESTART_BACKOFF_MIN] * workers
+        self.restart_at: List[float] = [0.0] * workers
+        self.snapshots: Dict[int, Dict[str, float]] = {}
+        self.restarts = 0
+        self.running = True
+
+    def spawn(self, index: int) -> None:
+        process = self.context.Process(
+            target=run_worker,
+            args=(self.config, index, self.metrics_queue),
+            name=f"dinodns-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+
+        logger.info(
+            f'msg="Starting supervisor" workers={self.workers} pid={os.getpid()}'
+        )
+        for index in range(self.workers):
+            self.spawn(index)
+
+        next_report = time.monotonic() + self.config.metrics_interval
+        while self.running:
+            self.collect_metrics(timeout=0.5)
+            self.check_workers()
+            if self.config.metrics_interval > 0 and time.monotonic() >= next_report:
+                self.report_metrics()
+                next_report = time.monotonic() + self.config.metrics_interval
+
+        self.shutdown()
+
+    def check_workers(self) -> None:
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                continue
+
+            if process is not None:
+                uptime = now - self.started_at[index]
+                if uptime >= STABLE_UPTIME:
+                    self.backoff[index] = RESTART_BACKOFF_MIN
+                logger.warning(
+                    f'msg="Worker exited" worker={index} pid={process.pid} exitcode={process.exitcode} restart_in={self.backoff[index]}s'
+                )
+                self.processes[index] = None
+                self.snapshots.pop(index, None)
+                self.restart_at[index] = now + self.backoff[index]
+                self.backoff[index] = min(self.backoff[index] * 2, RESTART_BACKOFF_MAX)
+
+            if now >= self.restart_at[index]:
+                self.restarts += 1
+                self.spawn(index)
+
+    def collect_metrics(self, timeout: float) -> None:
+        try:
+            index, values = self.metrics_queue.get(timeout=timeout)
+            self.snapshots[index] = values
+            while True:
+                index, values = self.metrics_queue.get_nowait()
+                self.snapshots[index] = values
+        except Empty:
+            pass
+
+    def report_metrics(self) -> None:
+        values = merge(self.snapshots.values())
+        values["workers.alive"] = sum(
+            1 for process in self.processes if process is not None and process.is_alive()
+        )
+        values["workers.restarts"] = self.restarts
+        log_metrics(values)
+
+    def reload(self, *_: Any) -> None:
+        logger.info('msg="Reloading workers"')
+        for process in self.processes:
+            if process is not None and process.pid is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    def stop(self, *_: Any) -> None:
+        self.running = False
+
+    def shutdown(self) -> None:
+        logger.info('msg="Shutting down"')
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=5)
@@ -0,0 +1,128 @@
+from socket import AF_INET, SO_REUSEADDR, SO_REUSEPORT, SOCK_STREAM, SOL_SOCKET, socket
+from threading import Thread
+from typing import Set
+from dinodns.async_server import forward_query
+from dinodns.server import DinoDNS
+import asyncio
+import struct
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TIMEOUT = 10.0
+DEFAULT_MAX_CONNECTIONS = 1000
+# Queries one connection may have outstanding before we stop reading from it
+MAX_PIPELINED = 64
+LISTEN_BACKLOG = 1024
+
+LENGTH_STRUCT = struct.Struct("!H")
+
+
+class TCPServer:
+    """DNS over TCP (RFC 7766): 2-byte length-prefixed messages on reusable connections.
+
+    Each query read from a connection is answered by its own task, so
+    pipelined queries are answered as they complete, in any order. A
+    connection with nothing outstanding is closed after `idle_timeout`
+    seconds, and connections beyond `max_connections` are turned away.
+    """
+
+    def __init__(
+        self,
+        server: DinoDNS,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+    ) -> None:
+        self.server = server
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.connections = 0
+        server.metrics.gauge("tcp.connections", lambda: self.connections)
+
+    def bind(self) -> socket:
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if self.server.reuse_port:
+            sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((str(self.server.host), self.server.port))
+        sock.listen(LISTEN_BACKLOG)
+        logger.info(
+            f'msg="TCP listening on {self.server.host}:{self.server.port}" max_connections={self.max_connections} idle_timeout={self.idle_timeout}'
+        )
+        return sock
+
+    async def listen(self) -> asyncio.Server:
+        return await asyncio.start_server(self.handle_connection, sock=self.bind())
+
+    async def serve(self) -> None:
+        listener = await self.listen()
+        async with listener:
+            await listener.serve_forever()
+
+    def start_background(self) -> None:
+        """Serve TCP on an event loop of its own, next to a threaded UDP engine."""
+        Thread(target=asyncio.run, args=(self.serve(),), name="tcp", daemon=True).start()
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        metrics = self.server.metrics
+        if self.connections >= self.max_connections:
+            metrics.inc("tcp.rejected")
+            writer.close()
+            return
+
+        self.connections += 1
+        metrics.inc("tcp.accepted")
+        pending: Set["asyncio.Task[None]"] = set()
+        try:
+            while True:
+                try:
+                    header = await asyncio.wait_for(
+                        reader.readexactly(LENGTH_STRUCT.size), self.idle_timeout
+                    )
+                except asyncio.TimeoutError:
+                    if pending:
+                        continue  # not idle while answers are still owed
+                    metrics.inc("tcp.idle_closed")
+                    break
+                (length,) = LENGTH_STRUCT.unpack(header)
+                data = await asyncio.wait_for(
+                    reader.readexactly(length), self.idle_timeout
+                )
+                metrics.inc("tcp.queries")
+
+                task = asyncio.ensure_future(self.answer(data, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                if len(pending) >= MAX_PIPELINED:
+                    await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass  # client closed the connection or stalled mid-message
+        finally:
+            # A client may half-close once its queries are sent
+            if pending:
+                await asyncio.wait(pending)
+            self.connections -= 1
+            writer.close()
+
+    async def answer(self, data: bytes, writer: asyncio.StreamWriter) -> None:
+        server = self.server
+        try:
+            query = server.decode_query(data)
+            if isinstance(query, bytes):
+                response = query
+            else:
+                query.over_tcp()
+                response = (
+                    server.try_answer_locally(query)
+                    or await forward_query(server, query)
+                    or server.servfail(query)
+                )
+            if writer.is_closing():
+                return
+            writer.write(LENGTH_STRUCT.pack(len(response)) + response)
+            await writer.drain()
+        except Exception as e:
+            logger.error(f'msg="Error handling TCP query: {str(e) or type(e).__name__}"')
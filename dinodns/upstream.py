@@ -0,0 +1,435 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from socket import AF_INET, SOCK_DGRAM, create_connection, socket
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+from dinodns.core.header import DNSHeader
+from dinodns.metrics import Metrics
+from dinodns.utils import skip_domain_name
+import errno
+import secrets
+import struct
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+Address = Tuple[str, int]
+
+RECEIVE_SIZE = 65535
+# Queries to an upstream are spread over this many sockets, each bound by the
+# kernel to a random source port, and a socket is replaced once it is this
+# old: a spoofed reply must guess the port as well as the ID (RFC 5452)
+SOCKETS_PER_UPSTREAM = 4
+SOCKET_LIFETIME = 60.0
+# How often a receiver wakes to check whether its socket was retired
+RECEIVE_POLL = 1.0
+# recv errors that mean the socket itself is gone rather than one query failing
+FATAL_SOCKET_ERRORS = (errno.EBADF, errno.ENOTSOCK)
+QR_BIT = 0x80  # in the third header byte
+TC_BIT = 0x02  # in the third header byte
+
+# Answers too large for UDP are fetched again over TCP (RFC 7766)
+TCP_TIMEOUT = 4.0
+TCP_WORKERS = 16
+LENGTH_STRUCT = struct.Struct("!H")
+
+INITIAL_RTO = 1.0
+MIN_RTO = 0.3
+MAX_RTO = 2.0
+# For ranking, an upstream's srtt halves every this many seconds without a new
+# sample, so slower upstreams get re-measured at a rate set by time, not traffic
+SRTT_HALF_LIFE = 10.0
+
+# Consecutive failures that open an upstream's circuit breaker
+FAILURE_THRESHOLD = 3
+# Seconds an open breaker waits before letting one trial query through,
+# doubled after every failed trial
+TRIAL_BACKOFF_MIN = 1.0
+TRIAL_BACKOFF_MAX = 30.0
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    # One trial query is out; its answer closes the breaker, its failure reopens it
+    HALF_OPEN = "half_open"
+
+
+def question_section(data: bytes) -> bytes:
+    start = DNSHeader.HEADER_SIZE
+    return data[start : skip_domain_name(data, start) + 4]
+
+
+def is_truncated(data: bytes) -> bool:
+    return bool(data[2] & TC_BIT)
+
+
+def tcp_exchange(address: Address, raw_query: bytes) -> bytes:
+    """Send one query over a fresh TCP connection and return the whole reply."""
+    txid = secrets.randbits(16)
+    query = struct.pack("!H", txid) + raw_query[2:]
+    with create_connection(address, timeout=TCP_TIMEOUT) as connection:
+        connection.sendall(LENGTH_STRUCT.pack(len(query)) + query)
+        header = receive_exactly(connection, LENGTH_STRUCT.size)
+        (length,) = LENGTH_STRUCT.unpack(header)
+        data = receive_exactly(connection, length)
+
+    if (
+        len(data) < DNSHeader.HEADER_SIZE
+        or not data[2] & QR_BIT
+        or struct.unpack_from("!H", data)[0] != txid
+        or question_section(data) != question_section(query)
+    ):
+        raise ValueError("Mismatched TCP reply")
+    if is_truncated(data):
+        raise ValueError("Truncated TCP reply")
+    return data
+
+
+def receive_exactly(connection: socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Upstream closed the TCP connection")
+        data += chunk
+    return data
+
+
+@dataclass
+class RttEstimator:
+    """Smoothed round-trip time and retransmission timeout as in RFC 6298."""
+
+    srtt: float = 0.0
+    rttvar: float = 0.0
+    rto: float = INITIAL_RTO
+    measured: bool = False
+    # time.monotonic() of the last sample or timeout
+    updated: float = 0.0
+
+    def observe(self, rtt: float) -> None:
+        if self.measured:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        else:
+            self.srtt, self.rttvar, self.measured = rtt, rtt / 2, True
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        self.updated = time.monotonic()
+
+    def timeout(self) -> None:
+        self.rto = min(self.rto * 2, MAX_RTO)
+        self.srtt = max(self.srtt, self.rto)
+        self.updated = time.monotonic()
+
+    def decayed(self, now: float) -> float:
+        """srtt as ranking sees it, decayed by the time since it was last updated."""
+        return self.srtt * 0.5 ** ((now - self.updated) / SRTT_HALF_LIFE)
+
+
+class Channel:
+    """One connected UDP socket of an upstream's pool, with its own receiver thread."""
+
+    def __init__(self, upstream: "UpstreamSocket") -> None:
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.socket.settimeout(RECEIVE_POLL)
+        self.socket.connect(upstream.address)
+        self.opened_at = time.monotonic()
+        # time.monotonic() after which the receiver closes the socket, once retired
+        self.closes_at: Optional[float] = None
+        Thread(
+            target=upstream.receive,
+            args=(self,),
+            name=f"upstream-{upstream.address[0]}:{upstream.address[1]}",
+            daemon=True,
+        ).start()
+
+    def retire(self) -> None:
+        """Stop sending on this socket; replies already owed may still arrive."""
+        self.closes_at = time.monotonic() + MAX_RTO
+
+    def closed(self) -> bool:
+        return self.closes_at is not None and time.monotonic() >= self.closes_at
+
+
+@dataclass
+class PendingQuery:
+    question: bytes
+    future: "Future[bytes]"
+    sent_at: float
+    channel: Channel
+
+
+class UpstreamSocket:
+    """A small pool of connected UDP sockets multiplexing queries to an upstream.
+
+    Every query is sent under a fresh transaction ID on a randomly chosen
+    socket; receiver threads route replies back to the waiting future once
+    ID, question and socket match.
+    """
+
+    def __init__(self, address: Address, metrics: Metrics) -> None:
+        self.address = address
+        self.metrics = metrics
+        self.pending: Dict[int, PendingQuery] = {}
+        self.rtt = RttEstimator()
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.backoff = TRIAL_BACKOFF_MIN
+        # time.monotonic() from which an open breaker lets the next trial through
+        self.retry_at = 0.0
+        self.lock = Lock()
+        self.channels = [Channel(self) for _ in range(SOCKETS_PER_UPSTREAM)]
+
+    def query(self, raw_query: bytes) -> "Future[bytes]":
+        future: "Future[bytes]" = Future()
+        question = question_section(raw_query)
+        with self.lock:
+            channel = self.channel()
+            txid = secrets.randbits(16)
+            while txid in self.pending:
+                txid = secrets.randbits(16)
+            self.pending[txid] = PendingQuery(
+                question, future, time.monotonic(), channel
+            )
+        # A waiter that gives up cancels the future, which frees its ID
+        future.add_done_callback(lambda f: self.forget(txid, f))
+        try:
+            channel.socket.send(struct.pack("!H", txid) + raw_query[2:])
+        except OSError as e:
+            self.failed()
+            future.set_exception(e)
+        return future
+
+    def channel(self) -> Channel:
+        """A random socket of the pool, replaced first if it has grown too old."""
+        index = secrets.randbelow(len(self.channels))
+        channel = self.channels[index]
+        if time.monotonic() - channel.opened_at > SOCKET_LIFETIME:
+            channel.retire()
+            channel = self.channels[index] = Channel(self)
+        return channel
+
+    def forget(self, txid: int, future: "Future[bytes]") -> None:
+        with self.lock:
+            pending = self.pending.get(txid)
+            if pending is not None and pending.future is future:
+                del self.pending[txid]
+
+    def receive(self, channel: Channel) -> None:
+        while not channel.closed():
+            try:
+                data = channel.socket.recv(RECEIVE_SIZE)
+            except TimeoutError:
+                continue
+            except OSError as e:
+                if e.errno in FATAL_SOCKET_ERRORS:
+                    logger.error(
+                        f'msg="Upstream socket failed" upstream="{self.address[0]}" error="{e}"'
+                    )
+                    return
+                # An ICMP error (refused, host or network unreachable) for an
+                # earlier query, which will time out; later replies still arrive
+                self.metrics.inc("upstream.icmp_errors")
+                logger.debug(
+                    f'msg="Upstream unreachable" upstream="{self.address[0]}" error="{e}"'
+                )
+                continue
+
+            if len(data) < DNSHeader.HEADER_SIZE or not data[2] & QR_BIT:
+                self.reject(data)
+                continue
+            (txid,) = struct.unpack_from("!H", data)
+            if txid not in self.pending:
+                # Usually the losing side of a race or a query we stopped waiting for
+                self.metrics.inc("upstream.late")
+            elif not self.accept(channel, txid, data):
+                self.reject(data)
+        channel.socket.close()
+
+    def accept(self, channel: Channel, txid: int, data: bytes) -> bool:
+        with self.lock:
+            pending = self.pending.get(txid)
+            try:
+                if (
+                    pending is None
+                    or pending.channel is not channel
+                    or question_section(data) != pending.question
+                ):
+                    return False
+            except IndexError:
+                return False
+            del self.pending[txid]
+            self.rtt.observe(time.monotonic() - pending.sent_at)
+            self.failures = 0
+            closed = self.state == BreakerState.HALF_OPEN
+            if closed:
+                self.state = BreakerState.CLOSED
+        if closed:
+            self.metrics.inc(f"upstream.{self.address[0]}.breaker_closed")
+            logger.info(f'msg="Upstream circuit closed" upstream="{self.address[0]}"')
+        if pending.future.set_running_or_notify_cancel():
+            pending.future.set_result(data)
+        return True
+
+    def reject(self, data: bytes) -> None:
+        self.metrics.inc("upstream.rejected")
+        logger.warning(
+            f'msg="Rejected upstream reply" upstream="{self.address[0]}" len={len(data)}'
+        )
+
+    @property
+    def available(self) -> bool:
+        return self.state == BreakerState.CLOSED
+
+    def claim_trial(self) -> bool:
+        """Whether an open breaker lets a trial query through now, claiming it if so.
+
+        One trial goes out per back-off interval; the breaker is half-open
+        until it is answered or fails.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.state == BreakerState.CLOSED or now < self.retry_at:
+                return False
+            self.state = BreakerState.HALF_OPEN
+            self.retry_at = now + self.backoff
+        self.metrics.inc(f"upstream.{self.address[0]}.breaker_trials")
+        return True
+
+    def failed(self) -> None:
+        with self.lock:
+            self.rtt.timeout()
+            self.failures += 1
+            now = time.monotonic()
+            if self.state == BreakerState.HALF_OPEN:
+                self.state = BreakerState.OPEN
+                self.backoff = min(self.backoff * 2, TRIAL_BACKOFF_MAX)
+                self.retry_at = now + self.backoff
+                logger.debug(
+                    f'msg="Upstream trial failed" upstream="{self.address[0]}" retry_in={self.backoff}s'
+                )
+                return
+            if self.state == BreakerState.OPEN or self.failures < FAILURE_THRESHOLD:
+                return
+            self.state = BreakerState.OPEN
+            self.backoff = TRIAL_BACKOFF_MIN
+            self.retry_at = now + self.backoff
+        self.metrics.inc(f"upstream.{self.address[0]}.breaker_opened")
+        logger.warning(
+            f'msg="Upstream circuit opened" upstream="{self.address[0]}" failures={self.failures}'
+        )
+
+
+class Exchange:
+    """One query sent to one or more upstreams at once; the first valid reply wins.
+
+    `future` resolves with the winning address and reply, or with the last
+    error once every upstream failed. Waiters give up after `timeout`, the
+    largest RTO among the upstreams (MAX_RTO for the `last` attempt), and
+    then call `expire`.
+    """
+
+    def __init__(
+        self, upstreams: List[UpstreamSocket], raw_query: bytes, last: bool = False
+    ) -> None:
+        self.future: "Future[Tuple[Address, bytes]]" = Future()
+        # With nothing left to fail over to, a slow answer beats no answer
+        self.timeout = (
+            MAX_RTO if last else max(upstream.rtt.rto for upstream in upstreams)
+        )
+        self.lock = Lock()
+        self.failures = 0
+        self.queries = [(upstream, upstream.query(raw_query)) for upstream in upstreams]
+        for upstream, query in self.queries:
+            query.add_done_callback(
+                lambda query, upstream=upstream: self.settle(upstream, query)
+            )
+        self.future.add_done_callback(lambda _: self.close())
+
+    def settle(self, upstream: UpstreamSocket, query: "Future[bytes]") -> None:
+        if query.cancelled():
+            return
+        with self.lock:
+            if self.future.done():
+                return
+            error = query.exception()
+            if error is None:
+                self.future.set_result((upstream.address, query.result()))
+                return
+            self.failures += 1
+            if self.failures == len(self.queries):
+                self.future.set_exception(error)
+
+    def close(self) -> None:
+        for _, query in self.queries:
+            query.cancel()
+
+    def expire(self) -> None:
+        for upstream, query in self.queries:
+            if not query.done() or query.cancelled():
+                upstream.failed()
+        self.future.cancel()
+
+
+class UpstreamManager:
+    """Hands out the shared socket for each upstream, opening it on first use."""
+
+    def __init__(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+        self.sockets: Dict[Address, UpstreamSocket] = {}
+        self.lock = Lock()
+        self.tcp = ThreadPoolExecutor(TCP_WORKERS, thread_name_prefix="upstream-tcp")
+
+    def get(self, address: Address) -> UpstreamSocket:
+        upstream: Optional[UpstreamSocket] = self.sockets.get(address)
+        if upstream is None:
+            with self.lock:
+                upstream = self.sockets.get(address)
+                if upstream is None:
+                    upstream = self.sockets[address] = UpstreamSocket(
+                        address, self.metrics
+                    )
+        return upstream
+
+    def rank(self, addresses: List[Address]) -> List[Address]:
+        """Order available upstreams fastest first by smoothed RTT, skipping open breakers."""
+        now = time.monotonic()
+        upstreams = sorted(
+            (
+                upstream
+                for upstream in map(self.get, addresses)
+                if upstream.available
+            ),
+            key=lambda upstream: upstream.rtt.decayed(now),
+        )
+        return [upstream.address for upstream in upstreams]
+
+    def sample(
+        self, address: Address, read: Callable[[UpstreamSocket], float]
+    ) -> Optional[float]:
+        """`read` applied to an upstream's socket, or None before it is first used."""
+        upstream = self.sockets.get(address)
+        return None if upstream is None else read(upstream)
+
+    def trials(self, addresses: List[Address]) -> List[Address]:
+        """Upstreams with an open breaker that are due a trial query, claiming it."""
+        return [
+            upstream.address
+            for upstream in map(self.get, addresses)
+            if upstream.claim_trial()
+        ]
+
+    def exchange(
+        self, addresses: List[Address], raw_query: bytes, last: bool = False
+    ) -> Exchange:
+        return Exchange([self.get(address) for address in addresses], raw_query, last)
+
+    def tcp_query(self, address: Address, raw_query: bytes) -> "Future[bytes]":
+        """`raw_query` sent to `address` over TCP, for an answer truncated over UDP."""
+        return self.tcp.submit(tcp_exchange, address, raw_query)
+
+    def pending(self) -> int:
+        return sum(len(upstream.pending) for upstream in list(self.sockets.values()))
@@ -1,4 +1,10 @@
-from typing import Any, List, Tuple
+from typing import Any, List, Optional, Set, Tuple, Union
+from dinodns.core.wire import encode_labels
+import re
+
+
+# Anything the wire parsers read from; memoryview slices are not copied
+Buffer = Union[bytes, bytearray, memoryview]
 
 
 def format_bits(n: int, width: int) -> str:
@@ -25,34 +31,74 @@ def convert_keys(obj: Any) -> Any:
         return obj
 
 
+SIZE_UNITS = {
+    "": 1,
+    "B": 1,
+    "K": 1024,
+    "KB": 1024,
+    "KIB": 1024,
+    "M": 1024**2,
+    "MB": 1024**2,
+    "MIB": 1024**2,
+    "G": 1024**3,
+    "GB": 1024**3,
+    "GIB": 1024**3,
+}
+
+
+def parse_size(size: str) -> int:
+    """Parse a byte size such as "256MB", "64k" or "1048576"; units are binary."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*", size)
+    if match is None or match.group(2).upper() not in SIZE_UNITS:
+        raise ValueError(f"Invalid size: {size!r}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def normalize_domain_name(domain: str) -> str:
+    return domain.rstrip(".").lower()
+
+
+def qualify_domain_name(name: str, origin: str) -> str:
+    if name == "@":
+        return origin.rstrip(".") + "."
+    if name.endswith("."):
+        return name
+    return f"{name}.{origin.rstrip('.')}."
+
+
 def encode_domain_name(domain: str) -> bytes:
-    parts = domain.rstrip(".").split(".")
-    return (
-        b"".join(len(label).to_bytes(1, "big") + label.encode() for label in parts)
-        + b"\x00"
-    )
+    return encode_labels(domain, ".")
 
 
-def decode_domain_name(data: bytes, offset: int = 0) -> Tuple[str, int]:
+def encoded_length(name: str) -> int:
+    """Length of `name` as written by `encode_domain_name` or `encode_email`."""
+    # Each separator, "." or "@", becomes a length byte either way
+    return len(encode_labels(name, "."))
+
+
+def decode_domain_name(data: Buffer, offset: int = 0) -> Tuple[str, int]:
     labels: List[str] = []
     initial_offset = offset
     jumped = False
-    visited_offsets = set()
+    visited_offsets: Optional[Set[int]] = None
+    size = len(data)
 
     while True:
-        if offset >= len(data):
+        if offset >= size:
             raise ValueError("decode_domain_name: offset beyond data length")
 
         length = data[offset]
 
         # Compression: pointer (starts with 11)
         if (length & 0xC0) == 0xC0:
-            if offset + 1 >= len(data):
+            if offset + 1 >= size:
                 raise ValueError("decode_domain_name: pointer truncated")
 
             pointer = ((length & 0x3F) << 8) | data[offset + 1]
 
-            if pointer in visited_offsets:
+            if visited_offsets is None:
+                visited_offsets = set()
+            elif pointer in visited_offsets:
                 raise ValueError("decode_domain_name: compression loop")
 
             visited_offsets.add(pointer)
@@ -70,35 +116,43 @@ def decode_domain_name(data: bytes, offset: int = 0) -> Tuple[str, int]:
             break
 
         offset += 1
-        if offset + length > len(data):
+        if offset + length > size:
             raise ValueError("decode_domain_name: label length out of bounds")
 
-        label = data[offset : offset + length].decode("ascii")
-        labels.append(label)
+        labels.append(str(data[offset : offset + length], "ascii"))
         offset += length
 
     domain_name = ".".join(labels) + "."
     return domain_name, (initial_offset if jumped else offset)
 
 
+def skip_domain_name(data: Buffer, offset: int = 0) -> int:
+    while True:
+        length = data[offset]
+        if (length & 0xC0) == 0xC0:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += 1 + length
+
+
 def encode_email(email: str) -> bytes:
     if "@" not in email:
         raise ValueError("Invalid email: missing '@'")
+    return encode_labels(email, "@")
 
-    parts = email.rstrip(".").split("@")
-    return (
-        b"".join(len(label).to_bytes(1, "big") + label.encode() for label in parts)
-        + b"\x00"
-    )
 
-
-def decode_email(data: bytes) -> Tuple[str, int]:
+def decode_email(data: Buffer, offset: int = 0) -> Tuple[str, int]:
     labels: list[str] = []
-    offset = 0
     while data[offset] != 0:
         length = data[offset]
+        if (length & 0xC0) == 0xC0:
+            # The rest of the address is a compressed domain name
+            domain, offset = decode_domain_name(data, offset)
+            labels.append(domain.rstrip("."))
+            return "@".join(labels), offset
         offset += 1
-        labels.append(data[offset : offset + length].decode())
+        labels.append(str(data[offset : offset + length], "utf-8"))
         offset += length
     offset += 1  # null terminator
     result = "@".join(labels)
@@ -0,0 +1,146 @@
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+from dinodns.utils import normalize_domain_name
+import logging
+
+if TYPE_CHECKING:
+    from dinodns.catalog import RRset, Zone
+
+
+logger = logging.getLogger(__name__)
+
+WILDCARD_LABEL = "*"
+
+
+class LookupStatus(Enum):
+    ANSWER = 0
+    NODATA = 1
+    NXDOMAIN = 2
+    DELEGATION = 3
+    NOTAUTH = 4  # Outside of every hosted zone
+
+
+@dataclass
+class ZoneNode:
+    children: Dict[str, "ZoneNode"] = field(default_factory=dict)
+    # (type, class) -> RRset
+    rrsets: Dict[Tuple[str, str], "RRset"] = field(default_factory=dict)
+    zone: Optional["Zone"] = None
+
+    def is_zone_cut(self) -> bool:
+        return self.zone is None and ("NS", "IN") in self.rrsets
+
+
+@dataclass
+class LookupResult:
+    status: LookupStatus
+    zone: Optional["Zone"] = None
+    rrset: Optional["RRset"] = None
+    soa: Optional["RRset"] = None
+    wildcard: bool = False
+
+
+def split_labels(domain: str) -> List[str]:
+    name = normalize_domain_name(domain)
+    if not name:
+        return []
+    labels = name.split(".")
+    labels.reverse()
+    return labels
+
+
+class ZoneTree:
+    """Reversed-label tree of every hosted zone and owner name."""
+
+    def __init__(self) -> None:
+        self.root = ZoneNode()
+
+    def _insert(self, domain: str) -> ZoneNode:
+        node = self.root
+        for label in split_labels(domain):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = ZoneNode()
+            node = child
+        return node
+
+    def add_zone(self, zone: "Zone") -> None:
+        node = self._insert(zone.origin)
+        if node.zone is not None:
+            logger.warning(f'msg="Duplicate zone ignored" zone={zone.origin}')
+            return
+        node.zone = zone
+
+    def add_rrset(self, domain: str, type: str, class_: str, rrset: "RRset") -> None:
+        self._insert(domain).rrsets[(type, class_)] = rrset
+
+    def lookup(self, qname: str, qtype: str, qclass: str) -> LookupResult:
+        node = self.root
+        apex: Optional[ZoneNode] = node if node.zone is not None else None
+        cut: Optional[ZoneNode] = None
+        matched = True
+
+        for label in split_labels(qname):
+            child = node.children.get(label)
+            if child is None:
+                matched = False
+                break
+            node = child
+            if node.zone is not None:
+                apex, cut = node, None
+            elif apex is not None and cut is None and node.is_zone_cut():
+                cut = node
+
+        if apex is None:
+            return LookupResult(status=LookupStatus.NOTAUTH)
+
+        if cut is not None:
+            return LookupResult(
+                status=LookupStatus.DELEGATION,
+                zone=apex.zone,
+                rrset=cut.rrsets[("NS", "IN")],
+            )
+
+        soa = apex.rrsets.get(("SOA", qclass))
+        wildcard = False
+        if not matched:
+            # `node` is now the closest encloser of qname
+            node = node.children.get(WILDCARD_LABEL)
+            if node is None:
+                return LookupResult(
+                    status=LookupStatus.NXDOMAIN, zone=apex.zone, soa=soa
+                )
+            wildcard = True
+
+        rrset = node.rrsets.get((qtype, qclass))
+        if rrset is None and qtype != "CNAME":
+            rrset = node.rrsets.get(("CNAME", qclass))
+        if rrset is None:
+            # Also covers empty non-terminals
+            return LookupResult(status=LookupStatus.NODATA, zone=apex.zone, soa=soa)
+
+        return LookupResult(
+            status=LookupStatus.ANSWER,
+            zone=apex.zone,
+            rrset=rrset,
+            wildcard=wildcard,
+        )
+
+    def authoritative_rrsets(
+        self,
+    ) -> Iterator[Tuple[str, str, str, "RRset"]]:
+        """Yield every RRset that is neither at nor below a zone cut."""
+        stack: List[Tuple[ZoneNode, List[str], bool]] = [(self.root, [], False)]
+        while stack:
+            node, labels, in_zone = stack.pop()
+            if node.zone is not None:
+                in_zone = True
+            elif node.is_zone_cut():
+                in_zone = False
+            if in_zone:
+                name = ".".join(reversed(labels))
+                for (type, class_), rrset in node.rrsets.items():
+                    yield name, type, class_, rrset
+            for label, child in node.children.items():
+                stack.append((child, labels + [label], in_zone))